@@ -9,27 +9,44 @@
 - 附件渲染使用精确 MIME（视频/音频更兼容）
 """
 
+import time
+APP_START = time.perf_counter()
+
 import streamlit as st
 import requests
+import asyncio
 import re
-import time
 import json
+import copy
 import hashlib
+import hmac
+import base64
+import gzip
 import secrets
-from datetime import datetime
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import uuid
-import google.generativeai as genai
-import pandas as pd
-from PIL import Image
 import io
+# google.generativeai / pandas / PIL / httpx 体积较大，改为首次使用时再导入（见“延迟加载”一节）
 
 # --- 页面基础设置 ---
 st.set_page_config(page_title="在线作业平台", page_icon="📚", layout="centered")
 
 # --- 全局常量 ---
 BASE_ONEDRIVE_PATH = "root:/Apps/HomeworkPlatform"
-COURSES_FILE_PATH = f"{BASE_ONEDRIVE_PATH}/all_courses.json"
-HOMEWORK_FILE_PATH = f"{BASE_ONEDRIVE_PATH}/all_homework.json"
+CATALOG_FILE_PATH = f"{BASE_ONEDRIVE_PATH}/catalog.json"
+# 分片前的全局文件，仅用于首次迁移
+LEGACY_COURSES_FILE_PATH = f"{BASE_ONEDRIVE_PATH}/all_courses.json"
+LEGACY_HOMEWORK_FILE_PATH = f"{BASE_ONEDRIVE_PATH}/all_homework.json"
+
+# --- 会话令牌（HMAC 签名，无需读取 sessions.json 即可校验） ---
+SESSION_TTL_SECONDS = 7 * 24 * 60 * 60
+REVOKED_SESSIONS_FILE = "revoked_sessions"
 
 # --- AI 指令常量（统一维护） ---
 AI_GRADING_PROMPT = """# 角色
@@ -58,6 +75,70 @@ AI_GRADING_PROMPT = """# 角色
 }
 """
 
+AI_QUESTION_GRADING_PROMPT = """# 角色
+你是一位严谨的教学助手。
+# 任务
+只批改下面这一道题。学生的回答包含文字和附件（图片、视频、音频、代码、PDF等），请综合分析全部材料。
+# 要求
+1. 本题满分 {max_score} 分，给出 0 到 {max_score} 之间的得分。
+2. 如果回答有误，必须给出正确答案和/或解题思路。
+# 输出格式
+请严格以JSON格式输出，不要包含其他文字：
+{{"grade": 8, "feedback": "本题的解答思路清晰，但..."}}
+"""
+
+AI_JSON_REPAIR_PROMPT = """下面是一段本应为合法JSON的文本，但格式有误（可能混入说明文字、缺少括号或引号、被截断）。
+请只修复格式，使其成为符合给定结构的合法JSON，不要修改其中的分数、评语或题目内容，不要添加任何解释。
+# 待修复文本
+"""
+
+# --- AI 结构化输出（JSON 模式的 response_schema） ---
+GRADING_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "overall_grade": {"type": "NUMBER"},
+        "overall_feedback": {"type": "STRING"},
+        "detailed_grades": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "question_index": {"type": "INTEGER"},
+                    "grade": {"type": "NUMBER"},
+                    "feedback": {"type": "STRING"},
+                },
+                "required": ["question_index", "grade", "feedback"],
+            },
+        },
+    },
+    "required": ["overall_grade", "overall_feedback", "detailed_grades"],
+}
+QUESTION_GRADING_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"grade": {"type": "NUMBER"}, "feedback": {"type": "STRING"}},
+    "required": ["grade", "feedback"],
+}
+HOMEWORK_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "title": {"type": "STRING"},
+        "questions": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "id": {"type": "STRING"},
+                    "type": {"type": "STRING", "enum": ["text", "multiple_choice"]},
+                    "question": {"type": "STRING"},
+                    "options": {"type": "ARRAY", "items": {"type": "STRING"}},
+                },
+                "required": ["id", "type", "question"],
+            },
+        },
+    },
+    "required": ["title", "questions"],
+}
+
 # --- 支持的文件类型 ---
 SUPPORTED_FILE_TYPES = {
     "image": ['png', 'jpg', 'jpeg', 'webp'],
@@ -69,14 +150,18 @@ SUPPORTED_FILE_TYPES = {
 ALL_SUPPORTED_EXTENSIONS = [ext for category in SUPPORTED_FILE_TYPES.values() for ext in category]
 
 # --- 初始化 Session State ---
-if 'logged_in' not in st.session_state: st.session_state.logged_in = False
-if 'user_email' not in st.session_state: st.session_state.user_email = ""
-if 'login_step' not in st.session_state: st.session_state.login_step = "enter_email"
-if 'selected_course_id' not in st.session_state: st.session_state.selected_course_id = None
-if 'viewing_homework_id' not in st.session_state: st.session_state.viewing_homework_id = None
-if 'grading_submission' not in st.session_state: st.session_state.grading_submission = None
-if 'ai_grade_result' not in st.session_state: st.session_state.ai_grade_result = None
-if 'confirming_delete_course_id' not in st.session_state: st.session_state.confirming_delete_course_id = None
+def init_session_state():
+    if 'logged_in' not in st.session_state: st.session_state.logged_in = False
+    if 'user_email' not in st.session_state: st.session_state.user_email = ""
+    if 'login_step' not in st.session_state: st.session_state.login_step = "enter_email"
+    if 'selected_course_id' not in st.session_state: st.session_state.selected_course_id = None
+    if 'viewing_homework_id' not in st.session_state: st.session_state.viewing_homework_id = None
+    if 'viewing_course_id' not in st.session_state: st.session_state.viewing_course_id = None
+    if 'grading_submission' not in st.session_state: st.session_state.grading_submission = None
+    if 'ai_grade_result' not in st.session_state: st.session_state.ai_grade_result = None
+    if 'ai_question_results' not in st.session_state: st.session_state.ai_question_results = None
+    if 'per_question_grading' not in st.session_state: st.session_state.per_question_grading = False
+    if 'confirming_delete_course_id' not in st.session_state: st.session_state.confirming_delete_course_id = None
 
 # --- API 配置 ---
 try:
@@ -85,91 +170,422 @@ except KeyError:
     st.error("Microsoft Graph API 密钥未配置，文件相关功能将不可用。")
     MS_GRAPH_CONFIG = {}
 
-try:
+GEMINI_MODEL_NAME = 'models/gemini-2.5-flash'
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+# ---------------- 延迟加载 ----------------
+# 每个新会话都会从头执行本脚本。重量级模块与 Gemini / Graph 客户端不在脚本顶部初始化，
+# 而是首次用到时通过 st.cache_resource 创建一次、所有会话共享；只看登录页的会话不会触发它们。
+# 各项初始化耗时记录在 get_startup_timings() 中，教师仪表盘可查看。
+
+@st.cache_resource
+def get_startup_timings():
+    return {}
+
+def record_startup_timing(name, started_at):
+    get_startup_timings()[name] = time.perf_counter() - started_at
+
+@st.cache_resource
+def get_genai():
+    started_at = time.perf_counter()
+    import google.generativeai as genai
     genai.configure(api_key=st.secrets["gemini_api"]["api_key"])
-    MODEL = genai.GenerativeModel('models/gemini-2.5-flash')
-    SAFETY_SETTINGS = [
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-    ]
-except Exception as e:
-    st.error(f"Gemini API密钥配置失败: {e}")
+    record_startup_timing("Gemini SDK 加载", started_at)
+    return genai
+
+@st.cache_resource
+def get_gemini_model_or_error():
+    """返回 (默认模型, 错误信息)；失败结果同样缓存，避免每次调用都重复导入与配置。"""
+    try:
+        return get_genai().GenerativeModel(GEMINI_MODEL_NAME), None
+    except Exception as e:
+        return None, str(e)
+
+def get_gemini_model():
+    """默认模型；未配置时在页面上报错并返回 None。"""
+    model, error = get_gemini_model_or_error()
+    if model is None:
+        st.error(f"Gemini API密钥配置失败: {error}")
+    return model
+
+@st.cache_resource
+def get_graph_http_session():
+    """进程级共享的 requests.Session，复用到 Graph 的 TCP/TLS 连接。"""
+    return requests.Session()
+
+class GraphTokenProvider:
+    """客户端凭据令牌的进程级缓存。独立于 st.cache_data，页面上的 st.cache_data.clear() 不会迫使重新换取令牌。"""
+
+    REFRESH_MARGIN_SECONDS = 300
+
+    def __init__(self):
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def token(self):
+        with self._lock:
+            if self._token and time.time() < self._expires_at - self.REFRESH_MARGIN_SECONDS:
+                return self._token
+            started_at = time.perf_counter()
+            url = f"{MS_GRAPH_CONFIG.get('login_base_url', 'https://login.microsoftonline.com')}/{MS_GRAPH_CONFIG['tenant_id']}/oauth2/v2.0/token"
+            data = {
+                "grant_type": "client_credentials",
+                "client_id": MS_GRAPH_CONFIG['client_id'],
+                "client_secret": MS_GRAPH_CONFIG['client_secret'],
+                "scope": "https://graph.microsoft.com/.default",
+            }
+            resp = get_graph_http_session().post(url, data=data, timeout=20)
+            resp.raise_for_status()
+            payload = resp.json()
+            self._token = payload["access_token"]
+            self._expires_at = time.time() + int(payload.get("expires_in", 3600))
+            record_startup_timing("Graph 令牌获取", started_at)
+            return self._token
+
+@st.cache_resource
+def get_graph_token_provider():
+    return GraphTokenProvider()
 
 # ---------------- 工具函数 ----------------
 
 def get_email_hash(email: str) -> str:
     return hashlib.sha256(email.lower().encode('utf-8')).hexdigest()
 
-@st.cache_data(ttl=3500)
+# 工作线程没有 ScriptRunContext，其中的 st.error 不会显示；并发写入时先收集，由脚本线程统一显示
+_collected_errors = contextvars.ContextVar("collected_errors", default=None)
+
+def show_error(message):
+    collected = _collected_errors.get()
+    if collected is None:
+        st.error(message)
+    else:
+        collected.append(message)
+
 def get_ms_graph_token():
     if not MS_GRAPH_CONFIG:
         return None
-    url = f"https://login.microsoftonline.com/{MS_GRAPH_CONFIG['tenant_id']}/oauth2/v2.0/token"
-    data = {
-        "grant_type": "client_credentials",
-        "client_id": MS_GRAPH_CONFIG['client_id'],
-        "client_secret": MS_GRAPH_CONFIG['client_secret'],
-        "scope": "https://graph.microsoft.com/.default",
-    }
-    resp = requests.post(url, data=data)
-    resp.raise_for_status()
-    return resp.json()["access_token"]
+    return get_graph_token_provider().token()
+
+def graph_drive_url(path):
+    # graph_base_url / login_base_url 可在 secrets 中覆盖，压测时指向本地模拟服务（见 loadtest.py）
+    base_url = f"{MS_GRAPH_CONFIG.get('graph_base_url', 'https://graph.microsoft.com/v1.0')}/users/{MS_GRAPH_CONFIG['sender_email']}/drive"
+    # 分页返回的 @odata.nextLink 已是完整 URL
+    return path if path.startswith(("https://", "http://")) else f"{base_url}/{path}"
+
+# ---------------- 存储编码 ----------------
+# JSON 文档以紧凑格式写入（无缩进、无多余空白）；超过阈值的文档再压缩，并以版本头标记：
+#   b"HWJ1:gzip\n" + gzip 数据   或   b"HWJ1:zstd\n" + zstd 数据
+# 读取时按文件头识别，没有文件头的按普通 JSON 解析，旧文件无需迁移。
+# 安装了 orjson 时用它序列化和解析，否则退回标准库 json。
+# zstd 需要 zstandard 包；只有所有副本都已安装时才能把 STORAGE_CODEC 设为 "zstd"。
+
+STORAGE_FORMAT_MAGIC = b"HWJ1:"
+STORAGE_CODEC = "gzip"
+STORAGE_COMPRESS_MIN_BYTES = 1024
+
+def _json_dumps_compact(data) -> bytes:
+    try:
+        import orjson
+    except ImportError:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+def _json_loads(raw: bytes):
+    try:
+        import orjson
+    except ImportError:
+        return json.loads(raw)
+    return orjson.loads(raw)
+
+def encode_json_document(data) -> bytes:
+    raw = _json_dumps_compact(data)
+    if len(raw) < STORAGE_COMPRESS_MIN_BYTES:
+        return raw
+    if STORAGE_CODEC == "zstd":
+        import zstandard
+        return STORAGE_FORMAT_MAGIC + b"zstd\n" + zstandard.ZstdCompressor(level=10).compress(raw)
+    return STORAGE_FORMAT_MAGIC + b"gzip\n" + gzip.compress(raw, compresslevel=6)
+
+def decode_json_document(content: bytes):
+    """解析任意版本写入的 JSON 文档；格式无法识别或数据损坏时抛出 ValueError。"""
+    try:
+        if not content.startswith(STORAGE_FORMAT_MAGIC):
+            return _json_loads(content)
+        header, _, body = content.partition(b"\n")
+        codec = header[len(STORAGE_FORMAT_MAGIC):]
+        if codec == b"gzip":
+            return _json_loads(gzip.decompress(body))
+        if codec == b"zstd":
+            import zstandard
+            return _json_loads(zstandard.ZstdDecompressor().decompress(body))
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"无法解析存储文档: {e}") from e
+    raise ValueError(f"未知的存储编码: {codec!r}")
+
+# ---------------- Graph 熔断与降级读取 ----------------
+# Graph 变慢或限流时，每次请求都要等满超时再失败，页面会把“读取失败”误显示成“没有数据”。
+# - 熔断器：连续失败达到阈值后在一段时间内直接失败，不再发出请求；冷却后放行一次试探请求。
+# - 最近一次成功值：JSON 读取成功（含 404）时记录结果；读取失败或熔断期间立即返回该值，
+#   并在后台重新验证。健康时仍然直接读取远端，保证写入后读到的是最新数据。
+# 本次页面运行中发生过降级时，页面顶部显示“数据可能不是最新”的提示。
+
+GRAPH_BREAKER_FAILURE_THRESHOLD = 5
+GRAPH_BREAKER_OPEN_SECONDS = 30
+LAST_KNOWN_GOOD_MAX_ENTRIES = 2000
+READ_FAILED = object()   # 异步读取的失败标记，与 404（None）区分
+
+class GraphCircuitBreaker:
+    def __init__(self):
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._probing and time.time() - self._opened_at >= GRAPH_BREAKER_OPEN_SECONDS:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures, self._opened_at, self._probing = 0, None, False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= GRAPH_BREAKER_FAILURE_THRESHOLD:
+                self._opened_at, self._probing = time.time(), False
+
+@st.cache_resource
+def get_graph_circuit_breaker():
+    return GraphCircuitBreaker()
+
+# 降级标记只记在当前页面运行上（熔断器是进程级的，其他会话的失败不应让本页面显示提示）。
+# 后台线程中没有运行标记，它们的降级读取不计入任何页面。
+_run_degradation = contextvars.ContextVar("run_degradation", default=None)
+
+def begin_storage_run():
+    """每次页面运行开始时调用，重置本次运行的降级标记。"""
+    _run_degradation.set({"degraded": False})
+
+def mark_storage_degraded():
+    state = _run_degradation.get()
+    if state is not None:
+        state["degraded"] = True
+
+class LastKnownGoodCache:
+    """进程级 LRU：路径 -> 最近一次成功读取的 JSON 值（文件不存在时为 None）。"""
+
+    def __init__(self, max_entries=LAST_KNOWN_GOOD_MAX_ENTRIES):
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def put(self, path, value):
+        with self._lock:
+            self._entries[path] = copy.deepcopy(value)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, path):
+        """返回 (是否命中, 值)。返回副本，调用方可以放心修改。"""
+        with self._lock:
+            if path not in self._entries:
+                return False, None
+            self._entries.move_to_end(path)
+            return True, copy.deepcopy(self._entries[path])
+
+@st.cache_resource
+def get_last_known_good_cache():
+    return LastKnownGoodCache()
+
+def is_graph_failure(resp) -> bool:
+    return resp is None or resp.status_code == 429 or resp.status_code >= 500
+
+def serve_last_known_good(path, is_json):
+    """读取失败时的降级：返回最近一次成功值（没有则 None），并安排后台重新验证。"""
+    mark_storage_degraded()
+    if not is_json:
+        return None
+    found, value = get_last_known_good_cache().get(path)
+    if found:
+        get_background_tasks().submit_once(("revalidate", path), get_onedrive_data, path)
+    return value
+
+def is_storage_degraded() -> bool:
+    """本次页面运行中是否发生过读取失败 / 返回旧值，或熔断器处于打开状态。"""
+    state = _run_degradation.get()
+    return get_graph_circuit_breaker().is_open or bool(state and state["degraded"])
+
+def render_storage_status_banner(placeholder):
+    if is_storage_degraded():
+        placeholder.warning("⚠️ 云端存储暂时无法访问，页面显示的可能不是最新数据，部分操作可能失败。请稍后刷新。")
+
+# 调用方可以设置计数器统计自己发出的 Graph 请求数（后台存储维护据此限制每次运行的请求量）
+_graph_request_counter = contextvars.ContextVar("graph_request_counter", default=None)
+
+def count_graph_requests(n=1):
+    counter = _graph_request_counter.get()
+    if counter is not None:
+        counter[0] += n
 
 def onedrive_api_request(method, path, headers, data=None, params=None):
     if not MS_GRAPH_CONFIG:
         return None
-    base_url = f"https://graph.microsoft.com/v1.0/users/{MS_GRAPH_CONFIG['sender_email']}/drive"
-    url = f"{base_url}/{path}"
+    count_graph_requests()
+    breaker = get_graph_circuit_breaker()
+    if not breaker.allow():
+        return None
+    url = graph_drive_url(path)
+    session = get_graph_http_session()
+    resp = None
     try:
         if method.lower() == 'get':
-            return requests.get(url, headers=headers, params=params, timeout=20)
-        if method.lower() == 'put':
-            return requests.put(url, headers=headers, data=data, timeout=20)
-        if method.lower() == 'delete':
-            return requests.delete(url, headers=headers, timeout=20)
+            resp = session.get(url, headers=headers, params=params, timeout=20)
+        elif method.lower() == 'put':
+            resp = session.put(url, headers=headers, data=data, timeout=20)
+        elif method.lower() == 'delete':
+            resp = session.delete(url, headers=headers, timeout=20)
+        elif method.lower() == 'patch':
+            resp = session.patch(url, headers=headers, data=data, timeout=20)
     except requests.exceptions.RequestException as e:
-        st.error(f"API 请求失败: {e}")
-    return None
+        show_error(f"API 请求失败: {e}")
+    if is_graph_failure(resp):
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return resp
 
-def get_onedrive_data(path, is_json=True):
+def get_onedrive_data(path, is_json=True, allow_stale=True):
+    """allow_stale=False 用于条件写入前的读取等必须拿到最新值的场景，失败时返回 None。"""
     try:
-        token = get_ms_graph_token()
+        try:
+            token = get_ms_graph_token()
+        except Exception:
+            return serve_last_known_good(path, is_json) if allow_stale else None
         if not token:
             return None
         headers = {"Authorization": f"Bearer {token}"}
         resp = onedrive_api_request('get', f"{path}:/content", headers)
-        if resp is None:
-            return None
+        if is_graph_failure(resp):
+            return serve_last_known_good(path, is_json) if allow_stale else None
         if resp.status_code == 404:
+            if is_json:
+                get_last_known_good_cache().put(path, None)
             return None
         resp.raise_for_status()
-        return resp.json() if is_json else resp.content
+        if not is_json:
+            return resp.content
+        data = decode_json_document(resp.content)
+        get_last_known_good_cache().put(path, data)
+        return data
     except Exception:
         return None
 
-def save_onedrive_data(path, data, is_json=True) -> bool:
+def save_onedrive_data(path, data, is_json=True, etag=None) -> bool:
+    """
+    etag 用于条件写入：
+    - 传入 eTag 时仅当远端版本未变才写入（If-Match）；
+    - 传入 "" 时要求文件尚不存在（If-None-Match: *）；
+    - 条件不满足（412）时静默返回 False，由调用方决定是否重试。
+    """
     try:
         token = get_ms_graph_token()
         if not token:
             return False
         headers = {"Authorization": f"Bearer {token}"}
+        if etag:
+            headers["If-Match"] = etag
+        elif etag == "":
+            headers["If-None-Match"] = "*"
         if is_json:
-            headers["Content-Type"] = "application/json"
-            content = json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+            content = encode_json_document(data)
+            headers["Content-Type"] = "application/octet-stream" if content.startswith(STORAGE_FORMAT_MAGIC) else "application/json"
         else:
             headers["Content-Type"] = "application/octet-stream"
             content = data
         resp = onedrive_api_request('put', f"{path}:/content", headers, data=content)
-        if resp is None:
+        if resp is None or resp.status_code == 412:
             return False
         resp.raise_for_status()
+        if is_json:
+            get_last_known_good_cache().put(path, data)
         return resp.status_code in (200, 201, 202)
     except Exception as e:
-        st.error(f"保存数据失败: {e}")
+        show_error(f"保存数据失败: {e}")
+        return False
+
+def touch_onedrive_item(path) -> bool:
+    """更新文件的修改时间（仅元数据请求）；文件存在返回 True，不存在或失败返回 False。"""
+    try:
+        token = get_ms_graph_token()
+        if not token:
+            return False
+        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+        body = json.dumps({"fileSystemInfo": {"lastModifiedDateTime": datetime.utcnow().isoformat() + "Z"}})
+        resp = onedrive_api_request('patch', path, headers, data=body)
+        return resp is not None and resp.status_code == 200
+    except Exception:
         return False
 
+def get_onedrive_item_etag(path):
+    """读取文件元数据中的 eTag；文件不存在返回 ""，请求失败返回 None。"""
+    try:
+        token = get_ms_graph_token()
+        if not token:
+            return None
+        resp = onedrive_api_request('get', path, {"Authorization": f"Bearer {token}"})
+        if resp is None:
+            return None
+        if resp.status_code == 404:
+            return ""
+        resp.raise_for_status()
+        return resp.json().get('eTag')
+    except Exception:
+        return None
+
+def list_onedrive_children(path):
+    """
+    列出文件夹的全部子项（自动跟随 @odata.nextLink 翻页）。
+    - 文件夹不存在返回 []，请求失败返回 None，便于调用方区分“空”与“未知”。
+    """
+    try:
+        token = get_ms_graph_token()
+        if not token:
+            return None
+        headers = {"Authorization": f"Bearer {token}"}
+        items, next_path = [], f"{path}:/children"
+        while next_path:
+            resp = onedrive_api_request('get', next_path, headers)
+            if resp is None:
+                return None
+            if resp.status_code == 404:
+                return []
+            resp.raise_for_status()
+            body = resp.json()
+            items.extend(body.get('value', []))
+            next_path = body.get('@odata.nextLink')
+        return items
+    except Exception:
+        return None
+
 def delete_onedrive_item(path) -> bool:
     try:
         token = get_ms_graph_token()
@@ -196,11 +612,12 @@ def strip_code_fences(text: str) -> str:
     text = re.sub(r"```", "", text)
     return text.strip()
 
-def parse_ai_json(text: str) -> dict:
+def parse_ai_json(text: str, quiet: bool = False) -> dict:
     """
     尝试从 AI 返回的文本中解析出第一个 JSON 对象。
     - 自动去除代码围栏与多余说明。
     - 从第一个 '{' 到最后一个 '}' 提取片段后再 json.loads。
+    - quiet=True 时解析失败不在页面上报错（之后还会尝试修复）。
     """
     if not text:
         return {}
@@ -208,28 +625,61 @@ def parse_ai_json(text: str) -> dict:
     start = clean.find("{")
     end   = clean.rfind("}")
     if start == -1 or end == -1 or end <= start:
-        st.error("AI返回中未发现有效的 JSON 片段。")
-        st.code(text, language="text")
+        if not quiet:
+            st.error("AI返回中未发现有效的 JSON 片段。")
+            st.code(text, language="text")
         return {}
     try:
         return json.loads(clean[start:end+1])
     except Exception as e:
-        st.error(f"AI返回的JSON解析失败: {e}")
-        st.code(text, language="text")
+        if not quiet:
+            st.error(f"AI返回的JSON解析失败: {e}")
+            st.code(text, language="text")
         return {}
 
+def user_profile_path(email):
+    return f"{BASE_ONEDRIVE_PATH}/users/{get_email_hash(email)}.json"
+
 def get_user_profile(email):
-    return get_onedrive_data(f"{BASE_ONEDRIVE_PATH}/users/{get_email_hash(email)}.json")
+    return get_onedrive_data(user_profile_path(email))
 
 def save_user_profile(email, data):
-    return save_onedrive_data(f"{BASE_ONEDRIVE_PATH}/users/{get_email_hash(email)}.json", data, is_json=True)
+    return save_onedrive_data(user_profile_path(email), data, is_json=True)
 
-def get_global_data(file_name):
-    data = get_onedrive_data(f"{BASE_ONEDRIVE_PATH}/{file_name}.json")
+def global_data_path(file_name):
+    return f"{BASE_ONEDRIVE_PATH}/{file_name}.json"
+
+def get_global_data(file_name, allow_stale=True):
+    data = get_onedrive_data(global_data_path(file_name), allow_stale=allow_stale)
     return data if data else {}
 
 def save_global_data(file_name, data):
-    return save_onedrive_data(f"{BASE_ONEDRIVE_PATH}/{file_name}.json", data)
+    return save_onedrive_data(global_data_path(file_name), data)
+
+GLOBAL_DATA_UPDATE_ATTEMPTS = 8
+GLOBAL_DATA_RETRY_BASE_SECONDS = 0.05
+
+def update_global_data(file_name, update) -> bool:
+    """
+    以 eTag 条件写入做读-改-写：update(当前数据) 返回新数据（返回 None 表示无需写入）。
+    期间有其他写入（412）时随机退避后重新读取并重试，不会覆盖并发写入的条目。
+    """
+    path = global_data_path(file_name)
+    for attempt in range(GLOBAL_DATA_UPDATE_ATTEMPTS):
+        if attempt:
+            time.sleep(random.uniform(0, GLOBAL_DATA_RETRY_BASE_SECONDS * 2 ** min(attempt, 4)))
+        etag = get_onedrive_item_etag(path)
+        if etag is None:
+            return False
+        data = get_onedrive_data(path, allow_stale=False) if etag else {}
+        if data is None:
+            return False
+        new_data = update(data)
+        if new_data is None:
+            return True
+        if save_onedrive_data(path, new_data, etag=etag):
+            return True
+    return False
 
 def get_mime_type(filename: str):
     ext = filename.split('.')[-1].lower()
@@ -261,39 +711,128 @@ def handle_send_code(email: str):
     if not re.match(r"[^@]+@[^@]+\.[^@]+", email):
         st.sidebar.error("请输入有效的邮箱地址。")
         return
-    codes = get_global_data("codes")
-    code = "111111"  # 测试模式
-    codes[email.lower()] = {"code": code, "expires_at": time.time() + 300}
-    save_global_data("codes", codes)
+    issue_login_code(email)
     st.sidebar.success("测试模式：请输入 111111")
     st.session_state.login_step = "enter_code"
     st.session_state.temp_email = email
     st.rerun()
 
-def handle_verify_code(email, code):
+def issue_login_code(email: str) -> bool:
+    codes = get_global_data("codes")
+    code = "111111"  # 测试模式
+    codes[email.lower()] = {"code": code, "expires_at": time.time() + 300}
+    return save_global_data("codes", codes)
+
+def _b64url_encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _b64url_decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+@st.cache_resource
+def get_session_secret() -> bytes:
+    """
+    会话令牌签名密钥。
+    - 优先使用 secrets 中的 session.secret_key。
+    - 未配置时由 Graph client_secret 派生，保证多个副本签发的令牌互相可校验。
+    - 两者都缺失时退化为进程内随机密钥（重启后需重新登录）。
+    """
+    try:
+        return st.secrets["session"]["secret_key"].encode("utf-8")
+    except Exception:
+        pass
+    if MS_GRAPH_CONFIG.get("client_secret"):
+        return hashlib.sha256(f"session-signing:{MS_GRAPH_CONFIG['client_secret']}".encode("utf-8")).digest()
+    return secrets.token_bytes(32)
+
+def _sign_session_payload(payload_b64: str) -> str:
+    digest = hmac.new(get_session_secret(), payload_b64.encode("ascii"), hashlib.sha256).digest()
+    return _b64url_encode(digest)
+
+def create_session_token(email: str) -> str:
+    """签发自包含的会话令牌：base64url(JSON{e: 邮箱, x: 过期时间, j: 令牌ID}).签名"""
+    payload = {"e": email.lower(), "x": int(time.time() + SESSION_TTL_SECONDS), "j": secrets.token_hex(8)}
+    payload_b64 = _b64url_encode(json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+    return f"{payload_b64}.{_sign_session_payload(payload_b64)}"
+
+def decode_session_token(token: str):
+    """校验签名与有效期，返回令牌载荷；不做任何 I/O。无效时返回 None。"""
+    try:
+        payload_b64, signature = token.split(".", 1)
+        if not hmac.compare_digest(signature, _sign_session_payload(payload_b64)):
+            return None
+        payload = json.loads(_b64url_decode(payload_b64))
+    except Exception:
+        return None
+    if time.time() >= payload.get("x", 0):
+        return None
+    return payload
+
+@st.cache_data(ttl=60)
+def get_revoked_sessions():
+    """吊销列表：{令牌ID: 原过期时间}，只保存主动退出/强制失效的令牌，体积很小。"""
+    return get_global_data(REVOKED_SESSIONS_FILE)
+
+def revoke_session_token(token: str) -> bool:
+    payload = decode_session_token(token) if token else None
+    if not payload:
+        return False
+
+    def revoke(revoked):
+        now = time.time()
+        revoked = {jti: exp for jti, exp in revoked.items() if exp > now}
+        revoked[payload["j"]] = payload["x"]
+        return revoked
+
+    # 条件写入：同时退出登录的多个会话不会互相覆盖吊销记录
+    saved = update_global_data(REVOKED_SESSIONS_FILE, revoke)
+    get_revoked_sessions.clear()
+    return saved
+
+def validate_session_token(token: str):
+    """返回令牌对应的邮箱；签名无效、已过期或已吊销时返回 None。"""
+    if "." not in token:
+        # 兼容升级前签发的随机令牌，待其自然过期后此分支不再触发
+        session_info = get_global_data("sessions").get(token)
+        if session_info and time.time() < session_info.get("expires_at", 0):
+            return session_info["email"]
+        return None
+    payload = decode_session_token(token)
+    if not payload or payload["j"] in get_revoked_sessions():
+        return None
+    return payload["e"]
+
+def verify_login_code(email, code):
+    """校验验证码并在首次登录时创建档案。返回 (会话令牌, 错误信息, 是否新注册)，成功时错误信息为 None。"""
     email = email.lower()
     codes = get_global_data("codes")
     code_info = codes.get(email)
     if not code_info or time.time() > code_info["expires_at"]:
-        st.sidebar.error("验证码已过期或不存在。")
-        return
-    if code_info["code"] == code:
+        return None, "验证码已过期或不存在。", False
+    if code_info["code"] != code:
+        return None, "验证码错误。", False
+    is_new = False
+    with UnitOfWork() as uow:
         if not get_user_profile(email):
             new_profile = {"email": email, "created_at": datetime.utcnow().isoformat() + "Z"}
-            save_user_profile(email, new_profile)
-            st.toast("🎉 注册成功！请选择您的身份。")
-        sessions, token = get_global_data("sessions"), secrets.token_hex(16)
-        sessions[token] = {"email": email, "expires_at": time.time() + (7 * 24 * 60 * 60)}
-        save_global_data("sessions", sessions)
+            uow.put(user_profile_path(email), new_profile)
+            is_new = True
         del codes[email]
-        save_global_data("codes", codes)
-        st.session_state.logged_in = True
-        st.session_state.user_email = email
-        st.session_state.login_step = "logged_in"
-        set_session_query_param(token)
-        st.rerun()
-    else:
-        st.sidebar.error("验证码错误。")
+        uow.put(global_data_path("codes"), codes)
+    return create_session_token(email), None, is_new
+
+def handle_verify_code(email, code):
+    token, error, is_new = verify_login_code(email, code)
+    if error:
+        st.sidebar.error(error)
+        return
+    if is_new:
+        st.toast("🎉 注册成功！请选择您的身份。")
+    st.session_state.logged_in = True
+    st.session_state.user_email = email.lower()
+    st.session_state.login_step = "logged_in"
+    set_session_query_param(token)
+    st.rerun()
 
 def check_session_from_query_params():
     if st.session_state.get('logged_in'):
@@ -301,11 +840,10 @@ def check_session_from_query_params():
     token = st.query_params.get("session_token")
     if not token:
         return
-    sessions = get_global_data("sessions")
-    session_info = sessions.get(token)
-    if session_info and time.time() < session_info.get("expires_at", 0):
+    email = validate_session_token(token)
+    if email:
         st.session_state.logged_in = True
-        st.session_state.user_email = session_info["email"]
+        st.session_state.user_email = email
         st.session_state.login_step = "logged_in"
     elif "session_token" in st.query_params:
         # 新旧版本兼容清理
@@ -314,6 +852,14 @@ def check_session_from_query_params():
         except Exception:
             st.experimental_set_query_params()
 
+def is_admin(email) -> bool:
+    """管理员名单来自 secrets 中的 admin.emails；未配置时没有管理员。"""
+    try:
+        admin_emails = st.secrets["admin"]["emails"]
+    except Exception:
+        return False
+    return bool(email) and email.lower() in {e.lower() for e in admin_emails}
+
 def display_login_form():
     with st.sidebar:
         st.header("🔐 用户登录/注册")
@@ -331,106 +877,1730 @@ def display_login_form():
                 st.session_state.login_step = "enter_email"
                 st.rerun()
 
-def call_gemini_api(prompt_parts):
+# ---------------- AI 请求调度 ----------------
+# 所有模型调用（同步 call_gemini_api 与异步 call_gemini_many）都要先向进程级调度器申请一个并发槽位：
+# - 优先级：交互（单份批改、出题）> 批量批改 > 后台（学情分析、补习作业）；
+# - 同一优先级内按课程轮转，一门课程的大批量任务不会独占槽位；
+# - 批量任务每一项单独申请槽位，新的交互请求在下一项开始前就能插队；
+# - 部分槽位只留给交互请求，批量任务占满其余槽位时交互请求仍可立即执行。
+# 调用方用 `with ai_job(优先级, 课程ID):` 声明当前工作的类别，未声明时按交互请求处理。
+
+AI_PRIORITY_INTERACTIVE = 0
+AI_PRIORITY_BATCH = 1
+AI_PRIORITY_BACKGROUND = 2
+GEMINI_MAX_CONCURRENCY = 6
+GEMINI_INTERACTIVE_RESERVED_SLOTS = 2
+
+_current_ai_job = contextvars.ContextVar("ai_job", default=(AI_PRIORITY_INTERACTIVE, None))
+
+@contextmanager
+def ai_job(priority, tenant=None):
+    token = _current_ai_job.set((priority, tenant))
     try:
-        if 'MODEL' not in globals():
-            st.error("Gemini 模型未初始化。")
+        yield
+    finally:
+        _current_ai_job.reset(token)
+
+class GeminiScheduler:
+    def __init__(self, slots=GEMINI_MAX_CONCURRENCY, reserved=GEMINI_INTERACTIVE_RESERVED_SLOTS):
+        self._slots = slots
+        self._reserved = reserved
+        self._in_use = 0
+        self._waiting = {}   # 优先级 -> OrderedDict(课程 -> deque[Future])，按课程轮转
+        self._lock = threading.Lock()
+
+    def request(self, priority, tenant) -> Future:
+        """排队申请槽位，返回在分配到槽位时完成的 Future；用完后必须调用 release()。"""
+        future = Future()
+        with self._lock:
+            self._waiting.setdefault(priority, OrderedDict()).setdefault(tenant, deque()).append(future)
+            self._dispatch()
+        return future
+
+    def release(self):
+        with self._lock:
+            self._in_use -= 1
+            self._dispatch()
+
+    def queued(self, priority):
+        with self._lock:
+            return sum(len(q) for q in self._waiting.get(priority, {}).values())
+
+    def _dispatch(self):
+        for priority in sorted(self._waiting):
+            tenants = self._waiting[priority]
+            limit = self._slots if priority == AI_PRIORITY_INTERACTIVE else self._slots - self._reserved
+            while tenants and self._in_use < limit:
+                tenant, queue = next(iter(tenants.items()))
+                future = queue.popleft()
+                if queue:
+                    tenants.move_to_end(tenant)
+                else:
+                    del tenants[tenant]
+                if future.set_running_or_notify_cancel():
+                    self._in_use += 1
+                    future.set_result(None)
+            if tenants:
+                return   # 高优先级仍有排队时不向低优先级分配
+
+    @contextmanager
+    def slot(self, priority, tenant):
+        self.request(priority, tenant).result()
+        try:
+            yield
+        finally:
+            self.release()
+
+@st.cache_resource
+def get_gemini_scheduler():
+    return GeminiScheduler()
+
+def json_generation_config(response_schema):
+    if not response_schema:
+        return None
+    return {"response_mime_type": "application/json", "response_schema": response_schema}
+
+def call_gemini_api(prompt_parts, model=None, response_schema=None):
+    """
+    model 为空时使用默认模型；批改时可传入绑定了上下文缓存的模型。
+    传入 response_schema 时以 JSON 模式请求，模型输出受该结构约束。
+    """
+    try:
+        model = model or get_gemini_model()
+        if model is None:
             return None
         if isinstance(prompt_parts, str):
             prompt_parts = [prompt_parts]
-        response = MODEL.generate_content(prompt_parts, safety_settings=SAFETY_SETTINGS, request_options={"timeout": 600})
+        with get_gemini_scheduler().slot(*_current_ai_job.get()):
+            response = model.generate_content(prompt_parts, safety_settings=SAFETY_SETTINGS,
+                                              generation_config=json_generation_config(response_schema),
+                                              request_options={"timeout": 600})
         return response.text
     except Exception as e:
         st.error(f"调用AI时出错: {e}")
         return None
 
+def build_json_repair_prompt(text, response_schema):
+    return f"{AI_JSON_REPAIR_PROMPT}{text}\n# 目标结构\n{json.dumps(response_schema, ensure_ascii=False)}"
+
+def call_gemini_json(prompt_parts, response_schema, model=None) -> dict:
+    """
+    以 JSON 模式调用模型并解析结果。解析失败时只把原始文本交给模型做一次纯文本修复，
+    不重新发送附件；修复仍失败才在页面上报错并返回 {}。
+    """
+    text = call_gemini_api(prompt_parts, model=model, response_schema=response_schema)
+    if not text:
+        return {}
+    return repair_ai_json(text, response_schema)
+
+def repair_ai_json(text, response_schema) -> dict:
+    """解析模型输出；失败时做一次纯文本修复，仍失败则报错并返回 {}。"""
+    result = parse_ai_json(text, quiet=True)
+    if result:
+        return result
+    repaired = call_gemini_api(build_json_repair_prompt(text, response_schema), response_schema=response_schema)
+    return parse_ai_json(repaired or text)
+
+def call_gemini_json_many(requests_list, response_schema):
+    """
+    并发版 call_gemini_json。requests_list: [(prompt_parts, model 或 None)]。
+    返回与之对应的列表：解析成功为 dict，模型未返回内容为 None，修复后仍无法解析为 {}。
+    """
+    texts = call_gemini_many(requests_list, response_schema=response_schema)
+    results = [parse_ai_json(text, quiet=True) if text else None for text in texts]
+    broken = [i for i, (text, result) in enumerate(zip(texts, results)) if text and not result]
+    if broken:
+        repaired = call_gemini_many([(build_json_repair_prompt(texts[i], response_schema), None) for i in broken],
+                                    response_schema=response_schema)
+        for i, text in zip(broken, repaired):
+            results[i] = parse_ai_json(text, quiet=True) if text else {}
+    return results
+
+# ---------------- 异步 Graph / Gemini 客户端 ----------------
+# 列表型读取（N 个学生档案、N 份提交、N 个附件、N 条日志记录）和多次模型调用通过一个进程级
+# asyncio 事件循环并发执行，耗时约为一次往返而不是 N 次。事件循环运行在独立线程中，
+# Streamlit 脚本通过同步门面（fetch_onedrive_many / call_gemini_many）提交任务并等待结果。
+# 使用常驻事件循环而不是每次 asyncio.run，是为了复用 HTTP 连接池和 Gemini 的异步 gRPC 通道。
+
+GRAPH_MAX_CONCURRENCY = 16
+GRAPH_MAX_RETRIES = 3
+GRAPH_MAX_RETRY_WAIT_SECONDS = 10
+
+class AsyncRuntime:
+    def __init__(self):
+        import httpx
+        self._httpx = httpx
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="async-runtime", daemon=True).start()
+        self._graph_semaphore = asyncio.Semaphore(GRAPH_MAX_CONCURRENCY)
+        self._http = httpx.AsyncClient(timeout=20, follow_redirects=True,
+                                       limits=httpx.Limits(max_connections=GRAPH_MAX_CONCURRENCY))
+
+    def submit(self, coro):
+        """在常驻事件循环中调度协程，返回 concurrent.futures.Future，可配合 as_completed 逐个取结果。"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """同步门面：在常驻事件循环中执行协程并阻塞等待结果。"""
+        return self.submit(coro).result()
+
+    async def graph_get(self, path, token, is_json=True):
+        """404 返回 None，请求失败返回 READ_FAILED；遇到限流按 Retry-After 重试。结果计入熔断器。"""
+        headers = {"Authorization": f"Bearer {token}"}
+        breaker = get_graph_circuit_breaker()
+        for _ in range(GRAPH_MAX_RETRIES):
+            if not breaker.allow():
+                return READ_FAILED
+            async with self._graph_semaphore:
+                try:
+                    resp = await self._http.get(graph_drive_url(f"{path}:/content"), headers=headers)
+                except self._httpx.HTTPError:
+                    breaker.record_failure()
+                    return READ_FAILED
+            if resp.status_code in (429, 503):
+                breaker.record_failure()
+                wait = float(resp.headers.get("Retry-After", 1) or 1)
+                await asyncio.sleep(min(wait, GRAPH_MAX_RETRY_WAIT_SECONDS))
+                continue
+            if resp.status_code >= 500:
+                breaker.record_failure()
+                return READ_FAILED
+            breaker.record_success()
+            if resp.is_error:
+                return None
+            try:
+                return decode_json_document(resp.content) if is_json else resp.content
+            except ValueError:
+                return None
+        return READ_FAILED
+
+    async def graph_get_many(self, paths, token, is_json=True):
+        return await asyncio.gather(*(self.graph_get(path, token, is_json) for path in paths))
+
+    async def gemini_generate(self, prompt_parts, model, response_schema=None, job=(AI_PRIORITY_INTERACTIVE, None)):
+        """job 为 (优先级, 课程ID)，按调度器分配的槽位执行。"""
+        scheduler = get_gemini_scheduler()
+        granted = scheduler.request(*job)
+        try:
+            await asyncio.wrap_future(granted)
+        except asyncio.CancelledError:
+            if granted.done() and not granted.cancelled():
+                scheduler.release()
+            raise
+        try:
+            response = await model.generate_content_async(prompt_parts, safety_settings=SAFETY_SETTINGS,
+                                                          generation_config=json_generation_config(response_schema),
+                                                          request_options={"timeout": 600})
+            return response.text
+        except Exception:
+            return None
+        finally:
+            scheduler.release()
+
+    async def gemini_generate_many(self, requests_list, response_schema=None, job=(AI_PRIORITY_INTERACTIVE, None)):
+        return await asyncio.gather(*(self.gemini_generate(parts, model, response_schema, job) for parts, model in requests_list))
+
+@st.cache_resource
+def get_async_runtime():
+    return AsyncRuntime()
+
+def fetch_onedrive_many(paths, is_json=True):
+    """并发读取多个文件，返回与 paths 一一对应的列表（缺失或失败为 None）。"""
+    paths = list(paths)
+    if not paths or not MS_GRAPH_CONFIG:
+        return [None] * len(paths)
+    try:
+        token = get_ms_graph_token()
+    except Exception:
+        token = None
+    if not token:
+        return [serve_last_known_good(path, is_json) for path in paths]
+    count_graph_requests(len(paths))
+    results = get_async_runtime().run(get_async_runtime().graph_get_many(paths, token, is_json))
+    lkg = get_last_known_good_cache()
+    for i, (path, result) in enumerate(zip(paths, results)):
+        if result is READ_FAILED:
+            results[i] = serve_last_known_good(path, is_json)
+        elif is_json:
+            lkg.put(path, result)
+    return results
+
+def call_gemini_many(requests_list, response_schema=None):
+    """并发调用模型。requests_list: [(prompt_parts, model 或 None)]，返回与之对应的文本列表（失败为 None）。"""
+    requests_list = list(requests_list)
+    default_model = None
+    if any(model is None for _, model in requests_list):
+        default_model = get_gemini_model()
+        if default_model is None:
+            return [None] * len(requests_list)
+    normalized = [([parts] if isinstance(parts, str) else parts, model or default_model) for parts, model in requests_list]
+    # 事件循环线程没有调用方的上下文，这里显式传入当前工作的优先级与课程
+    return get_async_runtime().run(get_async_runtime().gemini_generate_many(normalized, response_schema, _current_ai_job.get()))
+
+# ---------------- 变更日志（追加写 + 后台合并） ----------------
+# 课程目录与各课程分片不再整体重写：每次修改只追加一条很小的变更记录到
+# <文档名>.journal/ 文件夹，读取时在快照上按顺序回放；记录数超过阈值后由后台任务合并进快照
+# （eTag 条件写入），再删除已合并的记录。
+# 单条操作可以重复执行，但 put→delete 这样的序列重放其中一段会让已删除的条目复活，
+# 因此合并后的快照记录水位线 {"watermark": 最后合并的记录名, "items": [...]}，
+# 读取与合并都跳过名称不大于水位线的记录（记录名以纳秒时间戳开头，按名称排序即按写入顺序）。
+# 从未合并过的快照仍是普通列表。
+#
+# 支持的操作（id 为记录主键，如 course_id / homework_id）：
+#   {"op": "put", "id": ..., "value": {...}}                        新增或整体替换
+#   {"op": "update", "id": ..., "fields": {...}}                    局部字段更新
+#   {"op": "delete", "id": ...}                                     删除
+#   {"op": "add_to_set" | "remove_from_set", "id": ..., "field": ..., "value": ...}
+
+JOURNAL_COMPACT_THRESHOLD = 20
+
+class BackgroundTasks:
+    """进程级后台任务池；同一 key 的任务同时只运行一个。"""
+
+    def __init__(self, max_workers=2, name="background"):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._in_flight = set()
+        self._debounced = {}   # key -> "waiting" | "running" | "rerun"
+        self._lock = threading.Lock()
+
+    def submit_once(self, key, fn, *args, **kwargs):
+        with self._lock:
+            if key in self._in_flight:
+                return None
+            self._in_flight.add(key)
+
+        def run():
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._in_flight.discard(key)
+        return self._executor.submit(run)
+
+    def submit_debounced(self, key, delay, fn, *args, **kwargs):
+        """
+        delay 秒后执行一次；等待期间同一 key 的提交直接合并，执行期间的提交合并为结束后再补跑一次，
+        保证最后一次提交之后至少完整执行过一次。
+        """
+        with self._lock:
+            state = self._debounced.get(key)
+            if state == "running":
+                self._debounced[key] = "rerun"
+            if state is not None:
+                return
+            self._debounced[key] = "waiting"
+
+        def run():
+            with self._lock:
+                self._debounced[key] = "running"
+            try:
+                fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    rerun = self._debounced.pop(key) == "rerun"
+                if rerun:
+                    self.submit_debounced(key, delay, fn, *args, **kwargs)
+
+        timer = threading.Timer(delay, self._executor.submit, args=(run,))
+        timer.daemon = True
+        timer.start()
+
+@st.cache_resource
+def get_background_tasks():
+    return BackgroundTasks()
+
+def journal_folder(doc_path: str) -> str:
+    return doc_path.removesuffix(".json") + ".journal"
+
+def read_journal_snapshot(data):
+    """返回 (条目列表, 水位线)；兼容没有水位线的列表快照。"""
+    if isinstance(data, dict):
+        return data.get("items", []), data.get("watermark", "")
+    return data or [], ""
+
+def make_journal_snapshot(items, watermark):
+    return {"watermark": watermark, "items": items} if watermark else items
+
+def apply_journal_ops(items, ops, key_field):
+    """在快照（字典列表）上按顺序回放变更操作，返回新列表，不修改入参。"""
+    items = list(items)
+    index = {item.get(key_field): i for i, item in enumerate(items)}
+    for op in ops:
+        kind, key = op.get("op"), op.get("id")
+        pos = index.get(key)
+        if kind == "put":
+            if pos is None:
+                index[key] = len(items)
+                items.append(op["value"])
+            else:
+                items[pos] = op["value"]
+        elif pos is None:
+            continue
+        elif kind == "delete":
+            items[pos] = None
+            del index[key]
+        elif kind == "update":
+            items[pos] = {**items[pos], **op.get("fields", {})}
+        elif kind in ("add_to_set", "remove_from_set"):
+            values = list(items[pos].get(op["field"], []))
+            if kind == "add_to_set" and op["value"] not in values:
+                values.append(op["value"])
+            elif kind == "remove_from_set" and op["value"] in values:
+                values.remove(op["value"])
+            items[pos] = {**items[pos], op["field"]: values}
+    return [item for item in items if item is not None]
+
+def append_journal_record(doc_path, ops) -> bool:
+    """追加一条变更记录；写入量只与本次变更大小有关，多个写入者互不覆盖。"""
+    record_name = f"{time.time_ns():020d}_{uuid.uuid4().hex[:8]}.json"
+    record = {"ops": ops, "at": datetime.utcnow().isoformat() + "Z"}
+    return save_onedrive_data(f"{journal_folder(doc_path)}/{record_name}", record, etag="")
+
+def load_journaled_document(doc_path, key_field, strict=False, _retry=True):
+    """
+    读取快照并回放变更记录。
+    strict=True 时任何读取失败都返回 None（而不是当作空文档），供需要区分“空”与“未知”的调用方使用。
+    """
+    folder = journal_folder(doc_path)
+    # 先列日志再读快照：若期间发生合并，新快照的水位线覆盖被合并的记录，回放时跳过它们
+    children = list_onedrive_children(folder)
+    etag = get_onedrive_item_etag(doc_path) if strict else None
+    if strict and (children is None or etag is None):
+        return None
+    if children is None:
+        # 列日志失败时只读快照会丢掉未合并的变更，优先返回上次完整加载的结果；
+        # 没有缓存时退回只读快照，同样标记为降级，页面会提示数据可能不完整
+        mark_storage_degraded()
+        found, document = get_last_known_good_cache().get(("journaled", doc_path))
+        if found:
+            return document
+    record_names = sorted(item['name'] for item in (children or []))
+    snapshot = get_onedrive_data(doc_path, allow_stale=not strict)
+    if strict and etag and snapshot is None:
+        return None
+    snapshot, watermark = read_journal_snapshot(snapshot)
+    pending_names = [name for name in record_names if name > watermark]
+    ops, missing = [], False
+    for record in fetch_onedrive_many(f"{folder}/{name}" for name in pending_names):
+        if record is None:
+            missing = True
+            continue
+        ops.extend(record.get("ops", []))
+    if missing and _retry:
+        # 记录在读取过程中被合并删除，重新读取一次新快照
+        return load_journaled_document(doc_path, key_field, strict=strict, _retry=False)
+    if missing and strict:
+        return None
+    if len(record_names) >= JOURNAL_COMPACT_THRESHOLD:
+        get_background_tasks().submit_once(("compact", doc_path), compact_journaled_document, doc_path, key_field)
+    document = apply_journal_ops(snapshot, ops, key_field)
+    if children is not None and not missing:
+        get_last_known_good_cache().put(("journaled", doc_path), document)
+    return document
+
+def compact_journaled_document(doc_path, key_field) -> bool:
+    """把已有变更记录合并进快照。快照以 eTag 条件写入，并发合并时只有一方成功。"""
+    etag = get_onedrive_item_etag(doc_path)
+    if etag is None:
+        return False
+    folder = journal_folder(doc_path)
+    record_names = sorted(item['name'] for item in (list_onedrive_children(folder) or []))
+    if not record_names:
+        return True
+    snapshot = get_onedrive_data(doc_path, allow_stale=False) if etag else []
+    if snapshot is None:
+        return False
+    snapshot, watermark = read_journal_snapshot(snapshot)
+    # 水位线以下的记录已在快照中（上次合并后删除失败的残留），直接删除
+    merged = [name for name in record_names if name <= watermark]
+    pending_names = [name for name in record_names if name > watermark]
+    ops, applied = [], []
+    for name, record in zip(pending_names, fetch_onedrive_many(f"{folder}/{name}" for name in pending_names)):
+        if record is None:
+            break  # 保持顺序：只合并连续读取成功的前缀
+        ops.extend(record.get("ops", []))
+        applied.append(name)
+    if applied:
+        compacted = make_journal_snapshot(apply_journal_ops(snapshot, ops, key_field), applied[-1])
+        if not save_onedrive_data(doc_path, compacted, etag=etag):
+            return False
+    for name in merged + applied:
+        delete_onedrive_item(f"{folder}/{name}")
+    return True
+
+# ---------------- 写入合并（Unit of Work） ----------------
+
+UOW_MAX_WORKERS = 8
+
+class UnitOfWork:
+    """
+    收集一次交互中的全部写入，提交时：
+    - 同一路径的多次写入/删除只保留最后一次，对同一文档的多次日志追加合并为一条记录；
+    - 普通写入并发执行，整体耗时约等于最慢的一次写入；
+    - 通过 put_last 登记的索引/元数据写入在其余写入全部成功后才执行，失败时不会留下指向缺失数据的索引；
+    - 通过 append_last 登记的派生索引日志（相似度索引、成绩册等）在 put_last 写入成功后才追加，
+      主记录保存失败时不会留下指向不存在提交的索引条目。
+
+        with UnitOfWork() as uow:
+            uow.put(attachment_path, file_bytes, is_json=False)
+            uow.put_last(submission_path, submission_data)
+            uow.append_last(index_path, ops)
+        if uow.succeeded: ...
+    """
+
+    def __init__(self):
+        self._writes = {}
+        self._final_writes = {}
+        self._derived_writes = {}
+        self.succeeded = None
+
+    def put(self, path, data, is_json=True):
+        self._writes[("file", path)] = lambda: save_onedrive_data(path, data, is_json=is_json)
+
+    def put_if_absent(self, path, data, is_json=False):
+        """内容寻址文件：已存在时只刷新修改时间（供存储清理判断引用），不重复上传。"""
+        self._writes[("file", path)] = lambda: touch_onedrive_item(path) or save_onedrive_data(path, data, is_json=is_json)
+
+    def delete(self, path):
+        self._writes[("file", path)] = lambda: delete_onedrive_item(path)
+
+    @staticmethod
+    def _merge_append(writes, doc_path, ops):
+        key = ("journal", doc_path)
+        pending_ops = writes[key].ops if key in writes else []
+        write = lambda: append_journal_record(doc_path, write.ops)
+        write.ops = pending_ops + list(ops)
+        writes[key] = write
+
+    def append(self, doc_path, ops):
+        self._merge_append(self._writes, doc_path, ops)
+
+    def put_last(self, path, data, is_json=True):
+        self._final_writes[path] = lambda: save_onedrive_data(path, data, is_json=is_json)
+
+    def append_last(self, doc_path, ops):
+        self._merge_append(self._derived_writes, doc_path, ops)
+
+    @staticmethod
+    def _run_concurrently(writes) -> bool:
+        if not writes:
+            return True
+        if len(writes) == 1:
+            return bool(writes[0]())
+        errors = []
+        context = contextvars.copy_context()
+
+        def run(write):
+            _collected_errors.set(errors)
+            return bool(write())
+
+        with ThreadPoolExecutor(max_workers=min(UOW_MAX_WORKERS, len(writes))) as executor:
+            succeeded = all(list(executor.map(lambda write: context.copy().run(run, write), writes)))
+        for message in dict.fromkeys(errors):
+            st.error(message)
+        return succeeded
+
+    def commit(self) -> bool:
+        self.succeeded = (self._run_concurrently(list(self._writes.values()))
+                          and self._run_concurrently(list(self._final_writes.values()))
+                          and self._run_concurrently(list(self._derived_writes.values())))
+        self._writes, self._final_writes, self._derived_writes = {}, {}, {}
+        return self.succeeded
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        return False
+
+# ---------------- 附件存储（内容寻址） ----------------
+# 新提交的附件按内容 SHA-256 存放在 blobs/<前两位>/<sha256>.<扩展名>，相同内容只存一份；
+# 提交记录中保存引用 {"name": 原文件名, "sha256": ..., "ext": ..., "size": ...}。
+# 旧提交中的附件仍是字符串文件名，存放在各自的提交文件夹下，以下辅助函数对两种格式都适用。
+# 缩略图、AI 文件句柄、批改缓存等下游缓存均可直接以 sha256 作为键。
+
+BLOB_STORE_PATH = f"{BASE_ONEDRIVE_PATH}/blobs"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def blob_file_name(sha256, ext):
+    return f"{sha256}.{ext}"
+
+def blob_path(sha256, ext):
+    return f"{BLOB_STORE_PATH}/{sha256[:2]}/{blob_file_name(sha256, ext)}"
+
+def hash_uploaded_file(uploaded_file):
+    """分块读取上传文件计算 SHA-256，返回 (sha256, 字节数)。"""
+    digest, size = hashlib.sha256(), 0
+    uploaded_file.seek(0)
+    while chunk := uploaded_file.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+        size += len(chunk)
+    uploaded_file.seek(0)
+    return digest.hexdigest(), size
+
+def make_attachment_ref(uploaded_file):
+    sha256, size = hash_uploaded_file(uploaded_file)
+    ext = uploaded_file.name.split('.')[-1].lower()
+    return {"name": uploaded_file.name, "sha256": sha256, "ext": ext, "size": size}
+
+def attachment_name(attachment):
+    return attachment['name'] if isinstance(attachment, dict) else attachment
+
+def attachment_hash(attachment):
+    return attachment.get('sha256') if isinstance(attachment, dict) else None
+
+def attachment_path(homework_id, student_email, attachment):
+    if isinstance(attachment, dict):
+        return blob_path(attachment['sha256'], attachment['ext'])
+    return f"{BASE_ONEDRIVE_PATH}/submissions/{homework_id}/{get_email_hash(student_email)}/{attachment}"
+
+def answers_for_prompt(answers):
+    """给 AI 的回答只保留附件原文件名，去掉哈希等存储细节。"""
+    return {q_key: {**answer, "attachments": [attachment_name(a) for a in answer.get('attachments', [])]}
+            for q_key, answer in answers.items()}
+
+# ---------------- 附件文本提取 ----------------
+# 代码文件与文字型 PDF 在本地提取为带行号的纯文本再交给模型，比以 inline_data 上传原始字节
+# 更省多模态处理与请求体积。扫描件或以图片为主的 PDF（多数页面几乎没有文字）仍上传原文件。
+# 提取结果按附件内容哈希缓存在进程级 LRU 中（不随 st.cache_data.clear() 清空），同一份文件反复批改只解析一次。
+
+ATTACHMENT_TEXT_MAX_CHARS = 30000
+ATTACHMENT_TEXT_CACHE_ENTRIES = 1000
+PDF_MIN_PAGE_CHARS = 50            # 文字少于此数的页面视为图片页
+PDF_MAX_IMAGE_PAGE_RATIO = 0.2     # 图片页占比超过此值时上传原 PDF
+
+def decode_text_bytes(file_bytes: bytes) -> str:
+    for encoding in ('utf-8-sig', 'gb18030'):
+        try:
+            return file_bytes.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return file_bytes.decode('utf-8', errors='replace')
+
+def format_extracted_text(text: str) -> str:
+    """加行号并限制长度，便于模型在评语中引用具体行。"""
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    width = len(str(len(lines)))
+    numbered = "\n".join(f"{i:>{width}} | {line}" for i, line in enumerate(lines, 1))
+    if len(numbered) > ATTACHMENT_TEXT_MAX_CHARS:
+        numbered = numbered[:ATTACHMENT_TEXT_MAX_CHARS] + f"\n……（内容过长已截断，原文共 {len(lines)} 行）"
+    return f"（以下为附件提取的文本，共 {len(lines)} 行）\n{numbered}"
+
+def extract_pdf_text(file_bytes: bytes):
+    """返回文字型 PDF 的全文；扫描件、图片为主或无法解析时返回 None。"""
+    try:
+        from pypdf import PdfReader
+        reader = PdfReader(io.BytesIO(file_bytes))
+        pages = [(page.extract_text() or "").strip() for page in reader.pages]
+    except Exception:
+        return None
+    if not pages:
+        return None
+    image_pages = sum(1 for text in pages if len(text) < PDF_MIN_PAGE_CHARS)
+    if image_pages / len(pages) > PDF_MAX_IMAGE_PAGE_RATIO:
+        return None
+    return "\n".join(f"[第 {i} 页]\n{text}" for i, text in enumerate(pages, 1))
+
+class ContentHashCache:
+    """
+    进程级 LRU：内容哈希 -> 由该内容派生的不可变结果（提取文本、栅格化图片等）。
+    内容哈希相同则结果相同，永不过期，只按容量淘汰；计算在锁外进行，并发时可能重复计算一次。
+    """
+
+    def __init__(self, max_entries):
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+@st.cache_resource
+def get_attachment_text_cache():
+    return ContentHashCache(ATTACHMENT_TEXT_CACHE_ENTRIES)
+
+def _extract_attachment_text(ext, file_bytes):
+    if ext in SUPPORTED_FILE_TYPES['code']:
+        text = decode_text_bytes(file_bytes)
+    elif ext in SUPPORTED_FILE_TYPES['document']:
+        text = extract_pdf_text(file_bytes)
+    else:
+        return None
+    return format_extracted_text(text) if text is not None else None
+
+def extract_attachment_text(content_hash, ext, file_bytes):
+    """按内容哈希缓存的提取结果；返回格式化文本，不适合提取时返回 None（上传原文件）。"""
+    return get_attachment_text_cache().get_or_compute((content_hash, ext), lambda: _extract_attachment_text(ext, file_bytes))
+
+# ---------------- 手写作答（矢量笔迹） ----------------
+# 手写板的笔迹以矢量形式保存为 .ink 附件（与其他附件一样按内容寻址存储）：
+#   b"HWINK1\n" + gzip(紧凑 JSON {"v": 1, "w": 宽, "h": 高, "s": [[颜色, 线宽, [x0, y0, dx1, dy1, ...]], ...]})
+# 坐标取整并做差分编码，体积通常只有同尺寸 PNG 照片的几十分之一。
+# 只有在批改或查看时才按需栅格化为 PNG（长边 INK_RASTER_LONG_SIDE 像素，适合模型识别），结果按内容哈希缓存。
+
+INK_EXTENSION = "ink"
+INK_MAGIC = b"HWINK1\n"
+INK_CANVAS_WIDTH = 600
+INK_CANVAS_HEIGHT = 360
+INK_RASTER_LONG_SIDE = 1024
+INK_PNG_CACHE_ENTRIES = 500
+
+def encode_ink_strokes(canvas_json, width=INK_CANVAS_WIDTH, height=INK_CANVAS_HEIGHT):
+    """把 drawable-canvas 的 fabric.js JSON 转为压缩笔迹；没有笔画时返回 None。"""
+    strokes = []
+    for obj in (canvas_json or {}).get("objects", []):
+        if obj.get("type") != "path":
+            continue
+        flat, last = [], None
+        for command in obj.get("path", []):
+            if len(command) < 3:
+                continue
+            point = (round(command[-2]), round(command[-1]))
+            if point == last:
+                continue
+            flat += [point[0], point[1]] if last is None else [point[0] - last[0], point[1] - last[1]]
+            last = point
+        if flat:
+            strokes.append([obj.get("stroke") or "#000000", round(float(obj.get("strokeWidth") or 3), 1), flat])
+    if not strokes:
+        return None
+    document = {"v": 1, "w": width, "h": height, "s": strokes}
+    return INK_MAGIC + gzip.compress(json.dumps(document, separators=(",", ":")).encode("utf-8"), compresslevel=9)
+
+def decode_ink_strokes(ink_bytes: bytes) -> dict:
+    if not ink_bytes.startswith(INK_MAGIC):
+        raise ValueError("不是手写笔迹文件")
+    return json.loads(gzip.decompress(ink_bytes[len(INK_MAGIC):]))
+
+@st.cache_resource
+def get_ink_png_cache():
+    return ContentHashCache(INK_PNG_CACHE_ENTRIES)
+
+def render_ink_png(content_hash, ink_bytes) -> bytes:
+    """把笔迹栅格化为 PNG；按内容哈希缓存在进程级 LRU 中（不随 st.cache_data.clear() 清空）。"""
+    return get_ink_png_cache().get_or_compute(content_hash, lambda: _rasterize_ink(ink_bytes))
+
+def _rasterize_ink(ink_bytes) -> bytes:
+    from PIL import Image, ImageDraw
+    document = decode_ink_strokes(ink_bytes)
+    scale = INK_RASTER_LONG_SIDE / max(document["w"], document["h"])
+    image = Image.new("RGB", (round(document["w"] * scale), round(document["h"] * scale)), "white")
+    draw = ImageDraw.Draw(image)
+    for color, width, flat in document["s"]:
+        x, y, points = 0, 0, []
+        for i in range(0, len(flat) - 1, 2):
+            x, y = (flat[i], flat[i + 1]) if i == 0 else (x + flat[i], y + flat[i + 1])
+            points.append((x * scale, y * scale))
+        line_width = max(1, round(width * scale))
+        if len(points) == 1:
+            (px, py), r = points[0], line_width / 2
+            draw.ellipse((px - r, py - r, px + r, py + r), fill=color)
+        else:
+            draw.line(points, fill=color, width=line_width, joint="curve")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+def make_bytes_attachment_ref(name, data: bytes):
+    return {"name": name, "sha256": hashlib.sha256(data).hexdigest(), "ext": name.split('.')[-1].lower(), "size": len(data)}
+
+def build_attachment_prompt_parts(homework_id, student_email, answers):
+    attachments = [a for answer_data in answers.values() for a in answer_data.get('attachments', [])]
+    contents = fetch_onedrive_many((attachment_path(homework_id, student_email, a) for a in attachments), is_json=False)
+    parts = []
+    for attachment, file_bytes in zip(attachments, contents):
+        if not file_bytes:
+            continue
+        filename = attachment_name(attachment)
+        parts.append(f"--- 附件 '{filename}' ---")
+        ext = filename.split('.')[-1].lower()
+        content_hash = attachment_hash(attachment) or hashlib.sha256(file_bytes).hexdigest()
+        if ext == INK_EXTENSION:
+            from PIL import Image
+            parts.append(Image.open(io.BytesIO(render_ink_png(content_hash, file_bytes))))
+            continue
+        extracted = extract_attachment_text(content_hash, ext, file_bytes)
+        if extracted is not None:
+            parts.append(extracted)
+            continue
+        mime_type = get_mime_type(filename)
+        if mime_type and mime_type.startswith('image/'):
+            from PIL import Image
+            parts.append(Image.open(io.BytesIO(file_bytes)))
+        elif mime_type:
+            parts.append({'inline_data': {'data': file_bytes, 'mime_type': mime_type}})
+    return parts
+
+# ---------------- AI 批改上下文缓存 ----------------
+# 同一份作业的批改请求中，AI_GRADING_PROMPT 与题目 JSON 完全相同，只有学生回答不同。
+# 这部分前缀通过 Gemini 上下文缓存（CachedContent）按作业创建一次，逐份批改时只发送学生回答与附件。
+# 缓存 TTL 随批改会话滑动续期；前缀过短等原因创建失败时自动退回完整提示词。
+
+GRADING_CACHE_TTL = timedelta(minutes=30)
+GRADING_CACHE_RENEW_MARGIN_SECONDS = 10 * 60   # 剩余时间不足时续期
+GRADING_CACHE_RETRY_SECONDS = 10 * 60          # 创建失败后多久再尝试
+
+class GradingContextCache:
+    """
+    作业 -> Future(缓存条目)。锁内只登记/查找条目，创建与续期的网络请求都在锁外进行：
+    同一作业并发批改时只有第一个请求创建缓存，其余请求等待同一个 Future，其他作业不受影响。
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(homework):
+        questions = json.dumps(homework['questions'], ensure_ascii=False, sort_keys=True)
+        return homework['homework_id'], hashlib.sha256(questions.encode('utf-8')).hexdigest()
+
+    def _create(self, homework, now):
+        try:
+            genai = get_genai()
+            from google.generativeai import caching
+            cached = caching.CachedContent.create(
+                model=GEMINI_MODEL_NAME,
+                display_name=f"grading-{homework['homework_id']}"[:128],
+                system_instruction=AI_GRADING_PROMPT,
+                contents=[f"【题目】: {json.dumps(homework['questions'], ensure_ascii=False)}"],
+                ttl=GRADING_CACHE_TTL,
+            )
+            model = genai.GenerativeModel.from_cached_content(cached_content=cached)
+            return {"cache": cached, "model": model, "expires_at": now + GRADING_CACHE_TTL.total_seconds()}
+        except Exception:
+            return {"cache": None, "model": None, "expires_at": now + GRADING_CACHE_RETRY_SECONDS}
+
+    def model_for(self, homework):
+        """返回绑定了该作业批改前缀缓存的模型；不可用时返回 None。"""
+        if get_gemini_model_or_error()[0] is None:
+            return None
+        key, now = self._key(homework), time.time()
+        creating, renewing = False, False
+        with self._lock:
+            self._entries = {k: f for k, f in self._entries.items() if not f.done() or f.result()['expires_at'] > now}
+            future = self._entries.get(key)
+            if future is None:
+                future = self._entries[key] = Future()
+                creating = True
+            elif future.done():
+                entry = future.result()
+                if (entry['cache'] is not None and not entry.get('renewing')
+                        and entry['expires_at'] - now < GRADING_CACHE_RENEW_MARGIN_SECONDS):
+                    entry['renewing'] = renewing = True
+        if creating:
+            future.set_result(self._create(homework, now))
+        entry = future.result()
+        if renewing:
+            try:
+                entry['cache'].update(ttl=GRADING_CACHE_TTL)
+                renewed_until = now + GRADING_CACHE_TTL.total_seconds()
+            except Exception:
+                renewed_until = None
+            with self._lock:
+                if renewed_until is not None:
+                    entry['expires_at'] = renewed_until
+                entry['renewing'] = False
+        return entry['model']
+
+@st.cache_resource
+def get_grading_context_cache():
+    return GradingContextCache()
+
+def build_grading_request(homework, student_email, answers):
+    """返回 (model, prompt_parts)。命中上下文缓存时只发送学生回答（增量）。"""
+    answers_part = f"【回答】: {json.dumps(answers_for_prompt(answers), ensure_ascii=False)}"
+    attachment_parts = build_attachment_prompt_parts(homework['homework_id'], student_email, answers)
+    cached_model = get_grading_context_cache().model_for(homework)
+    if cached_model is not None:
+        return cached_model, [answers_part] + attachment_parts
+    questions_part = f"【题目】: {json.dumps(homework['questions'], ensure_ascii=False)}"
+    return None, [AI_GRADING_PROMPT, f"{questions_part}\n{answers_part}"] + attachment_parts
+
+# ---------------- 逐题并行批改 ----------------
+# 可选模式：每道题单独调用一次模型并发批改，结果合并为与整份批改相同的
+# overall_grade / detailed_grades 结构。逐题结果按“题目 + 回答 + 附件”的指纹缓存在
+# submission['ai_question_results'] 中，回答未变的题目不会重复调用模型，也可以只重批某一题。
+
+def question_score(homework):
+    return round(100 / len(homework['questions']), 2) if homework['questions'] else 100
+
+def question_fingerprint(question, answer_data, max_score):
+    """题目（含答案、选项等全部评分字段）、满分、提示词与输出结构任一变化，逐题缓存都会失效。"""
+    answer_data = answer_data or {}
+    material = {
+        "prompt": hashlib.sha256(AI_QUESTION_GRADING_PROMPT.encode('utf-8')).hexdigest(),
+        "schema": QUESTION_GRADING_RESPONSE_SCHEMA,
+        "max_score": max_score,
+        "question": question,
+        "text": answer_data.get('text'),
+        "attachments": [attachment_hash(a) or attachment_name(a) for a in answer_data.get('attachments', [])],
+    }
+    return hashlib.sha256(json.dumps(material, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+def build_question_prompt(homework, student_email, index, answer_data):
+    question = homework['questions'][index]
+    prompt_parts = [
+        AI_QUESTION_GRADING_PROMPT.format(max_score=question_score(homework)),
+        f"【题目】: {json.dumps(question, ensure_ascii=False)}\n"
+        f"【回答】: {json.dumps(answers_for_prompt({'answer': answer_data})['answer'], ensure_ascii=False)}",
+    ]
+    prompt_parts += build_attachment_prompt_parts(homework['homework_id'], student_email, {question.get('id', f'q_{index}'): answer_data})
+    return prompt_parts
+
+def merge_question_results(homework, question_results):
+    """把逐题结果合并为整份批改结果结构。"""
+    detailed, total, lines = [], 0, []
+    for i, q in enumerate(homework['questions']):
+        result = question_results.get(q.get('id', f'q_{i}'))
+        if not result:
+            continue
+        grade = result.get('grade') or 0
+        detailed.append({"question_index": i, "grade": grade, "feedback": result.get('feedback', '')})
+        total += float(grade)
+        lines.append(f"第{i + 1}题（{grade}分）: {result.get('feedback', '')}")
+    return {"overall_grade": round(total), "overall_feedback": "\n".join(lines), "detailed_grades": detailed}
+
+def grade_submission_per_question(homework, submission, question_results=None, force_indices=()):
+    """
+    并发批改指纹有变化的题目（或 force_indices 指定的题目），返回 (合并结果, 逐题结果, 失败题号列表)。
+    question_results 为已有的逐题缓存，默认取 submission['ai_question_results']。
+    """
+    answers = submission.get('answers', {})
+    cached = dict(question_results if question_results is not None else submission.get('ai_question_results', {}))
+    pending = {}
+    for i, q in enumerate(homework['questions']):
+        q_key = q.get('id', f'q_{i}')
+        fingerprint = question_fingerprint(q, answers.get(q_key), question_score(homework))
+        if i in force_indices or cached.get(q_key, {}).get('fingerprint') != fingerprint:
+            pending[i] = (q_key, fingerprint)
+    failed = []
+    for i, (q_key, fingerprint) in list(pending.items()):
+        if not answers.get(q_key):
+            cached[q_key] = {"grade": 0, "feedback": "未作答。", "fingerprint": fingerprint}
+            del pending[i]
+    prompts = [(build_question_prompt(homework, submission['student_email'], i, answers.get(q_key)), None)
+               for i, (q_key, _) in pending.items()]
+    for (i, (q_key, fingerprint)), result in zip(pending.items(), call_gemini_json_many(prompts, QUESTION_GRADING_RESPONSE_SCHEMA)):
+        if not result or "grade" not in result:
+            failed.append(i)
+            cached.pop(q_key, None)
+        else:
+            cached[q_key] = {"grade": result["grade"], "feedback": result.get("feedback", ""), "fingerprint": fingerprint}
+    return merge_question_results(homework, cached), cached, failed
+
+# ---------------- AI 出题：并发候选与题库 ----------------
+# 一次出题并发生成 HOMEWORK_CANDIDATE_COUNT 份侧重点不同的候选方案，按完成顺序逐个展示，教师从中选用。
+# 生成结果按（课程名, 主题, 要求）——即提示词的全部可变部分——保存在 homework_generation/<哈希>.json，相同请求直接复用；
+# 发布后的题目按生成时的主题加入本课程题库 courses/<course_id>/question_library/<哈希>.json（变更日志文档），
+# 之后可不经模型直接选题组卷；删除课程时题库随课程文件夹一起删除。
+
+HOMEWORK_CANDIDATE_COUNT = 3
+HOMEWORK_CANDIDATE_ANGLES = ["侧重基础概念与核心知识点的理解", "侧重多个知识点的综合应用", "侧重真实场景中的实践任务"]
+
+def normalize_topic_text(text):
+    return re.sub(r"\s+", " ", (text or "").strip()).lower()
+
+def generation_cache_path(course_name, topic, details):
+    material = "\n".join(normalize_topic_text(part) for part in (course_name, topic, details))
+    key = hashlib.sha256(material.encode('utf-8')).hexdigest()
+    return f"{BASE_ONEDRIVE_PATH}/homework_generation/{key}.json"
+
+def question_library_path(course_id, topic):
+    key = hashlib.sha256(normalize_topic_text(topic).encode('utf-8')).hexdigest()
+    return f"{BASE_ONEDRIVE_PATH}/courses/{course_id}/question_library/{key}.json"
+
+def build_homework_generation_prompt(course_name, topic, details, angle=None):
+    prompt = f"""# 角色
+你是一位资深的教育专家与出题人，能够根据不同学科的特点，设计出高质量、有深度的作业题目。
+
+# 任务
+为课程“{course_name}”创建一份关于“{topic}”的作业。作业要求如下：{details}
+
+# 核心指令
+1.  **分析科目性质**: 首先，分析课程“{course_name}”和主题“{topic}”的性质。判断其是偏向于**实践技能**（如编程、网络、设计、营销策划）还是**理论知识**（如数学、物理、文学、历史）。
+2.  **匹配出题策略**:
+    * 对于**实践技能型**的科目，优先设计**场景化、任务导向**的实操题，要求学生动手操作、解决问题或制定方案。
+    * 对于**理论知识型**的科目，设计能够检验学生**概念理解、逻辑推理、分析应用能力**的题目。即使是理论题，也应尽量联系实际背景或设计巧妙的问题情境，避免死记硬背。
+3.  **明确任务要求**: 无论哪种类型的题目，都必须有明确的考核目标，并清晰地描述要求学生完成的任务（如“请证明”、“请分析”、“请列出步骤”、“请编写代码”等）,题目要覆盖所有要掌握的知识点，既有单个知识点，也有组合多个知识点的考察。
+
+# 输出格式要求
+你必须严格遵循以下JSON格式，不包含任何解释性文字或Markdown标记。
+
+**JSON格式模板 (包含不同类型实训题示例):**
+{{
+    "title": "{topic} - 综合能力作业",
+    "questions": [
+        {{
+            "id": "q0",
+            "type": "text",
+            "question": "【实践-网络】假设你是一家公司的网络管理员，有员工报告无法访问内部文件服务器。【任务】请详细列出你从接到报告到解决问题的完整故障排查步骤。"
+        }},
+        {{
+            "id": "q1",
+            "type": "text",
+            "question": "【理论-数学】在微积分中，导数代表了函数在某一点的瞬时变化率。【任务】请利用极限的定义，证明函数 f(x) = x² 的导数是 f'(x) = 2x。"
+        }},
+        {{
+            "id": "q2",
+            "type": "text",
+            "question": "【理论-文学】杜甫被誉为“诗圣”，其诗歌深刻反映了唐朝安史之乱时期的社会现实。【任务】请选择杜甫的《春望》或《石壕吏》，分析其如何通过具体的意象和叙事来体现“诗史”的特点。"
+        }},
+        {{
+            "id": "q3",
+            "type": "multiple_choice",
+            "question": "【实践-编程】在处理一个大型数据集时，你发现一个关键的计算函数执行效率低下，成为了程序的瓶颈。【问题】从算法优化的角度出发，你应该最优先考虑的改进方向是什么？",
+            "options": ["升级服务器硬件", "将Python代码替换为C++", "分析算法的时间复杂度，并寻找更高效的算法替代", "增加更多的日志输出来调试"]
+        }}
+    ]
+}}
+"""
+    if angle:
+        prompt += f"\n# 本方案侧重\n{angle}。\n"
+    return prompt
+
+def stream_homework_candidates(course_name, topic, details, count=HOMEWORK_CANDIDATE_COUNT):
+    """并发生成 count 份候选作业，按完成顺序逐个产出 (序号, 作业 dict；失败为 {})。"""
+    model = get_gemini_model()
+    if model is None:
+        return
+    runtime, job = get_async_runtime(), _current_ai_job.get()
+    futures = {}
+    for index in range(count):
+        angle = HOMEWORK_CANDIDATE_ANGLES[index % len(HOMEWORK_CANDIDATE_ANGLES)]
+        prompt = build_homework_generation_prompt(course_name, topic, details, angle)
+        futures[runtime.submit(runtime.gemini_generate([prompt], model, HOMEWORK_RESPONSE_SCHEMA, job))] = index
+    for future in as_completed(futures):
+        text = future.result()
+        yield futures[future], repair_ai_json(text, HOMEWORK_RESPONSE_SCHEMA) if text else {}
+
+def library_question(entry):
+    question = {"type": entry.get('type', 'text'), "question": entry['question']}
+    if entry.get('options'):
+        question['options'] = entry['options']
+    return question
+
+@st.cache_data(ttl=300)
+def get_question_library(course_id, topic):
+    return load_journaled_document(question_library_path(course_id, topic), "question_id")
+
+def add_to_question_library(course_id, topic, homework) -> bool:
+    ops = []
+    for q in homework['questions']:
+        question_id = hashlib.sha256(q['question'].encode('utf-8')).hexdigest()[:16]
+        ops.append({"op": "put", "id": question_id, "value": {
+            "question_id": question_id, "topic": topic, **library_question(q),
+            "source_homework_id": homework['homework_id'], "added_at": datetime.utcnow().isoformat() + "Z"}})
+    return append_journal_record(question_library_path(course_id, topic), ops) if ops else True
+
+def select_editable_homework(homework_json, topic):
+    """
+    把候选方案或题库组卷结果放入编辑区，并清掉编辑表单中上一份作业留下的输入。
+    topic 为生成该作业时的主题，发布时按它加入题库（主题输入框之后可能已被修改）。
+    """
+    for key in [k for k in st.session_state.keys() if k.startswith(("q_text_", "q_opts_", "edited_title_"))]:
+        del st.session_state[key]
+    st.session_state.editable_homework = copy.deepcopy(homework_json)
+    st.session_state.editable_homework_topic = topic
+
+# ---------------- 补习作业生成 ----------------
+# 薄弱题目相同的学生共用一次生成调用：先按“未达单题满分的题号集合”分组，
+# 各组通过 call_gemini_many 并发生成，再为组内每名学生复制一份独立的补习作业，最后由调用方一次性写入。
+
+REMEDIAL_SAMPLE_ANSWERS = 3   # 每道薄弱题附带的典型错误样例数
+REMEDIAL_FULL_MARKS_TOLERANCE = 0.01   # 单题满分取两位小数（如 3 题时为 33.33），比较时容许该取整误差
+
+def weak_question_indices(homework, submission):
+    """未达单题满分的题号；满分与逐题批改一致取 question_score()，并容许取整带来的误差。"""
+    full_marks = question_score(homework) - REMEDIAL_FULL_MARKS_TOLERANCE
+    return frozenset(g['question_index'] for g in submission.get('ai_detailed_grades', [])
+                     if g.get('grade', 0) < full_marks and g.get('question_index') is not None
+                     and 0 <= g['question_index'] < len(homework['questions']))
+
+def build_remedial_prompt(homework, weak_indices, submissions):
+    weak_points = []
+    for index in sorted(weak_indices):
+        question = homework['questions'][index]
+        samples = []
+        for sub in submissions[:REMEDIAL_SAMPLE_ANSWERS]:
+            grade = next((g for g in sub.get('ai_detailed_grades', []) if g.get('question_index') == index), {})
+            samples.append({"answer": sub['answers'].get(question.get('id', f'q_{index}'), {}).get('text'),
+                            "feedback": grade.get('feedback')})
+        weak_points.append({"question": question['question'], "typical_mistakes": samples})
+    prompt = f"""# 角色: 个性化辅导老师. # 任务: 根据学生薄弱点创建新的补习作业. # 薄弱点: {json.dumps(weak_points, ensure_ascii=False)} # 要求: 1-2道新题, 严格JSON输出.
+{{
+"title": "个性化补习 - {homework['title']}", "questions": [{{"id": "remedial_q0", "type": "text", "question": "这里是新的补习题目..."}}]
+}}
+"""
+    return prompt
+
+def generate_remedial_homework(course, homework, submissions):
+    """返回 (新作业列表, 成功学生列表, {失败学生: 原因})。"""
+    groups = {}
+    for sub in submissions:
+        weak = weak_question_indices(homework, sub)
+        if weak:
+            groups.setdefault(weak, []).append(sub)
+    new_hw, success_list, failed_dict = [], [], {}
+    if not groups:
+        return new_hw, success_list, failed_dict
+    with ai_job(AI_PRIORITY_BACKGROUND, course['course_id']):
+        responses = call_gemini_json_many([(build_remedial_prompt(homework, weak, subs), None) for weak, subs in groups.items()],
+                                          HOMEWORK_RESPONSE_SCHEMA)
+    for (weak, subs), remedial_set in zip(groups.items(), responses):
+        if not remedial_set:
+            reason = "AI未返回内容" if remedial_set is None else "AI返回格式无效"
+            failed_dict.update({sub['student_email']: reason for sub in subs})
+            continue
+        for sub in groups[weak]:
+            new_hw.append({**copy.deepcopy(remedial_set),
+                           "homework_id": str(uuid.uuid4()),
+                           "course_id": course['course_id'],
+                           "student_email": sub['student_email'],
+                           "original_hw_id": homework['homework_id']})
+            success_list.append(sub['student_email'])
+    return new_hw, success_list, failed_dict
+
+# ---------------- 相似提交检测 ----------------
+# 提交时为每份提交计算：
+# - fingerprint：全部回答文字与附件内容哈希的 SHA-256，完全相同的提交指纹相同；
+# - minhash：主观题文字的字符 shingle 与附件哈希的 MinHash 签名（选择题答案天然重复，不参与）。
+# 签名追加到 courses/<course_id>/similarity/<homework_id>.json，成绩册用 LSH 分桶找出候选对，
+# 只比较同桶的提交，整体近似线性；批量批改时指纹相同的提交直接复用已有批改结果。
+# 没有主观题文字和附件（minhash 为 None，如纯选择题或空白提交）的提交不参与雷同检测：
+# 选择题全对或都交白卷的学生指纹必然相同，不能据此判为抄袭。
+
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16                   # 16 段 × 每段 4 行
+SHINGLE_SIZE = 5
+SIMILARITY_THRESHOLD = 0.8
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_PARAMS = [(int.from_bytes(hashlib.sha256(f"minhash-a-{i}".encode()).digest()[:8], "big") % _MINHASH_PRIME or 1,
+                    int.from_bytes(hashlib.sha256(f"minhash-b-{i}".encode()).digest()[:8], "big") % _MINHASH_PRIME)
+                   for i in range(MINHASH_PERMUTATIONS)]
+
+def similarity_index_path(course_id, homework_id):
+    return f"{BASE_ONEDRIVE_PATH}/courses/{course_id}/similarity/{homework_id}.json"
+
+def normalize_answer_text(text):
+    return re.sub(r"\s+", " ", (text or "")).strip().lower()
+
+def submission_fingerprint(answers):
+    canonical = {q_key: {"text": normalize_answer_text(answer.get('text')),
+                         "attachments": sorted(attachment_hash(a) or f"legacy:{attachment_name(a)}"
+                                               for a in answer.get('attachments', []))}
+                 for q_key, answer in answers.items()}
+    return hashlib.sha256(json.dumps(canonical, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+def submission_shingles(homework, answers):
+    shingles = set()
+    for i, q in enumerate(homework['questions']):
+        answer = answers.get(q.get('id', f'q_{i}'), {})
+        if q.get('type') != 'multiple_choice':
+            text = normalize_answer_text(answer.get('text'))
+            if text:
+                shingles.update(f"{i}:{text[j:j + SHINGLE_SIZE]}" for j in range(max(len(text) - SHINGLE_SIZE + 1, 1)))
+        shingles.update(f"att:{attachment_hash(a)}" for a in answer.get('attachments', []) if attachment_hash(a))
+    return shingles
+
+def compute_minhash(shingles):
+    if not shingles:
+        return None
+    hashed = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), "big") for s in shingles]
+    return [min((a * h + b) % _MINHASH_PRIME for h in hashed) for a, b in _MINHASH_PARAMS]
+
+def build_similarity_entry(homework, submission):
+    answers = submission.get('answers', {})
+    return {"student_email": submission['student_email'], "submission_id": submission['submission_id'],
+            "fingerprint": submission_fingerprint(answers),
+            "minhash": compute_minhash(submission_shingles(homework, answers))}
+
+def find_similar_submissions(entries, threshold=SIMILARITY_THRESHOLD):
+    """LSH 分桶找候选对并用签名估计 Jaccard 相似度，返回 {email: [(相似的 email, 相似度), ...]}。"""
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    buckets = {}
+    for entry in entries:
+        if not entry.get('minhash'):
+            continue
+        buckets.setdefault(("fp", entry['fingerprint']), []).append(entry)
+        for band in range(LSH_BANDS):
+            key = (band, tuple(entry['minhash'][band * rows:(band + 1) * rows]))
+            buckets.setdefault(key, []).append(entry)
+    matches, seen = {}, set()
+    for bucket in buckets.values():
+        for i, a in enumerate(bucket):
+            for b in bucket[i + 1:]:
+                pair = tuple(sorted((a['student_email'], b['student_email'])))
+                if pair in seen or pair[0] == pair[1]:
+                    continue
+                seen.add(pair)
+                if a['fingerprint'] == b['fingerprint']:
+                    similarity = 1.0
+                else:
+                    similarity = sum(x == y for x, y in zip(a['minhash'], b['minhash'])) / MINHASH_PERMUTATIONS
+                if similarity >= threshold:
+                    matches.setdefault(a['student_email'], []).append((b['student_email'], similarity))
+                    matches.setdefault(b['student_email'], []).append((a['student_email'], similarity))
+    return matches
+
+@st.cache_data(ttl=60)
+def get_similarity_matches(course_id, homework_id):
+    entries = load_journaled_document(similarity_index_path(course_id, homework_id), "student_email")
+    return find_similar_submissions(entries)
+
+# ---------------- 成绩册物化视图 ----------------
+# 每门课程维护一份 courses/<course_id>/gradebook.json：每个“作业 × 学生”一个单元格，记录状态、
+# 最终得分与时间戳。提交、AI 批量批改、教师反馈时增量追加单元格，成绩册与导出只需读这一份文档；
+# 数据不一致时可在成绩册中“重建成绩册”，从全部提交重新生成。
+# 成绩册上线前已有的课程没有快照也没有变更记录，首次读取时自动从全部提交回填一次。
+
+def gradebook_path(course_id):
+    return course_shard_path(course_id, "gradebook")
+
+def gradebook_cell_id(homework_id, student_email):
+    return f"{homework_id}|{student_email}"
+
+def gradebook_cell(submission):
+    return {
+        "cell_id": gradebook_cell_id(submission['homework_id'], submission['student_email']),
+        "homework_id": submission['homework_id'],
+        "student_email": submission['student_email'],
+        "submission_id": submission.get('submission_id'),
+        "status": submission.get('status', 'submitted'),
+        "final_grade": submission.get('final_grade'),
+        "submitted_at": submission.get('timestamp'),
+        "released_at": submission.get('released_at'),
+    }
+
+def gradebook_ops(submissions):
+    return [{"op": "put", "id": cell['cell_id'], "value": cell} for cell in map(gradebook_cell, submissions)]
+
+def record_gradebook_changes(course_id, submissions) -> bool:
+    submissions = list(submissions)
+    return append_journal_record(gradebook_path(course_id), gradebook_ops(submissions)) if submissions else True
+
+@st.cache_data(ttl=30)
+def get_course_gradebook(course_id):
+    """返回 {(homework_id, student_email): 单元格}。"""
+    cells = load_journaled_document(gradebook_path(course_id), "cell_id")
+    if not cells and gradebook_missing(course_id) and rebuild_gradebook(course_id):
+        cells = load_journaled_document(gradebook_path(course_id), "cell_id")
+    return {(cell['homework_id'], cell['student_email']): cell for cell in cells}
+
+def gradebook_missing(course_id) -> bool:
+    """快照与变更记录都确定不存在（而不是读取失败）时返回 True，表示该课程的成绩册从未生成过。"""
+    doc_path = gradebook_path(course_id)
+    return get_onedrive_item_etag(doc_path) == "" and list_onedrive_children(journal_folder(doc_path)) == []
+
+def rebuild_gradebook(course_id) -> bool:
+    """从全部提交重建成绩册快照，并删除重建前已存在的变更记录（之后追加的记录保留，在新快照上回放）。"""
+    folder = journal_folder(gradebook_path(course_id))
+    stale_records = list_onedrive_children(folder)
+    if stale_records is None:
+        return False
+    cells = []
+    for hw in get_course_homework(course_id):
+        student_folders = list_onedrive_children(f"{BASE_ONEDRIVE_PATH}/submissions/{hw['homework_id']}")
+        if student_folders is None:
+            return False
+        paths = [f"{BASE_ONEDRIVE_PATH}/submissions/{hw['homework_id']}/{f['name']}/submission.json" for f in student_folders]
+        cells.extend(gradebook_cell(sub) for sub in fetch_onedrive_many(paths) if sub)
+    watermark = max((record['name'] for record in stale_records), default="")
+    if not save_onedrive_data(gradebook_path(course_id), make_journal_snapshot(cells, watermark)):
+        return False
+    with UnitOfWork() as uow:
+        for record in stale_records:
+            uow.delete(f"{folder}/{record['name']}")
+    return True
+
+# ---------------- 学情分析报告缓存 ----------------
+# 学情分析报告按作业保存在 courses/<course_id>/analysis/<homework_id>.json，并记录生成时的成绩指纹
+# （题目 + 成绩册中已反馈单元格的提交 ID / 分数 / 反馈时间）。指纹未变时直接展示已保存的报告，
+# 不再调用模型；有新的反馈发布后，已有报告会在后台提前重新生成（延迟并合并连续的发布，
+# 避免每批改一名学生就重新分析全班），教师也可以强制重新生成。
+
+ANALYSIS_MIN_GRADED = 2
+ANALYSIS_REFRESH_DELAY_SECONDS = 120   # 连续发布反馈时合并为一次重新生成
+
+def analysis_report_path(course_id, homework_id):
+    return f"{BASE_ONEDRIVE_PATH}/courses/{course_id}/analysis/{homework_id}.json"
+
+def analysis_fingerprint(homework, cells) -> str:
+    released = sorted((c.get('submission_id') or '', str(c.get('final_grade')), c.get('released_at') or '')
+                      for c in cells if c.get('status') == 'feedback_released')
+    payload = json.dumps([homework['questions'], released], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def build_analysis_prompt(homework, graded_submissions):
+    summary = [{"grade": s['final_grade'], "details": s.get('ai_detailed_grades', [])} for s in graded_submissions]
+    return f"""# 角色: 教育数据分析专家. # 数据: 作业题目: {json.dumps(homework['questions'], ensure_ascii=False)}, 全班匿名批改数据: {json.dumps(summary, ensure_ascii=False)}. # 任务: 生成详细的学情分析报告，包含: 1. 总体表现总结 (平均/最高/最低分, 分数段分布). 2. 知识点掌握情况 (逐题得分率, 优劣势分析). 3. 典型错误分析. 4. 教学建议."""
+
+@st.cache_data(ttl=60)
+def get_analysis_report(course_id, homework_id):
+    return get_onedrive_data(analysis_report_path(course_id, homework_id))
+
+def generate_analysis_report(course_id, homework, cells):
+    """按当前成绩生成并保存报告，返回报告文档；已批改人数过少时返回 {}，生成失败返回 None。"""
+    released_emails = [c['student_email'] for c in cells if c.get('status') == 'feedback_released']
+    if len(released_emails) < ANALYSIS_MIN_GRADED:
+        return {}
+    fingerprint = analysis_fingerprint(homework, cells)
+    paths = [student_submission_path(homework['homework_id'], email) for email in released_emails]
+    graded_submissions = [s for s in fetch_onedrive_many(paths) if s and s.get('status') == 'feedback_released']
+    if len(graded_submissions) < ANALYSIS_MIN_GRADED:
+        return {}
+    with ai_job(AI_PRIORITY_BACKGROUND, course_id):
+        report = call_gemini_api(build_analysis_prompt(homework, graded_submissions))
+    if not report:
+        return None
+    document = {
+        "homework_id": homework['homework_id'],
+        "fingerprint": fingerprint,
+        "graded_count": len(graded_submissions),
+        "generated_at": datetime.utcnow().isoformat() + "Z",
+        "report": report,
+    }
+    save_onedrive_data(analysis_report_path(course_id, homework['homework_id']), document)
+    return document
+
+def refresh_analysis_report(course_id, homework):
+    """后台任务：仅当该作业已有报告且成绩指纹已变化时重新生成。"""
+    existing = get_onedrive_data(analysis_report_path(course_id, homework['homework_id']))
+    if not existing:
+        return
+    cells = [c for c in load_journaled_document(gradebook_path(course_id), "cell_id")
+             if c['homework_id'] == homework['homework_id']]
+    if existing.get('fingerprint') != analysis_fingerprint(homework, cells):
+        generate_analysis_report(course_id, homework, cells)
+
+@st.cache_resource
+def get_analysis_tasks():
+    """分析报告重新生成要排队等待模型槽位、耗时很长，使用独立的任务池，不占用日志合并与降级重新验证的线程。"""
+    return BackgroundTasks(max_workers=1, name="analysis")
+
+def schedule_analysis_refresh(course_id, homework):
+    get_analysis_tasks().submit_debounced(("analysis", course_id, homework['homework_id']), ANALYSIS_REFRESH_DELAY_SECONDS,
+                                          refresh_analysis_report, course_id, homework)
+
 # ---------------- 课程/作业 数据层 ----------------
 
+# 数据按课程分片存放，每个视图只读取自己需要的分片：
+#   catalog.json                           轻量课程目录：course_id / course_name / teacher_email / join_code
+#   courses/<course_id>/roster.json        课程学生名单（按 email）
+#   courses/<course_id>/homework.json      本课程的作业（含个性化补习作业）
+#   memberships/<email_hash>.json          学生加入的课程（按 course_id）
+# 以上文档都通过变更日志追加写入。删除课程时不逐个清理学生的 membership，读取时按目录过滤即可。
+
+def course_shard_path(course_id, name):
+    return f"{BASE_ONEDRIVE_PATH}/courses/{course_id}/{name}.json"
+
+def membership_path(student_email):
+    return f"{BASE_ONEDRIVE_PATH}/memberships/{get_email_hash(student_email)}.json"
+
+@st.cache_resource
+def get_migration_state():
+    return {"done": False}
+
+def migrate_legacy_global_data() -> bool:
+    """
+    每个进程成功执行一次：目录尚不存在而旧版 all_courses.json 存在时，把全局数据拆分为分片。
+    目录最后以 If-None-Match 写入，多个副本同时迁移时只有一方生效，其余写入的分片内容相同。
+    读取或任一分片写入失败时不写目录、不标记完成，下次读取目录时重试。
+    """
+    state = get_migration_state()
+    if state["done"]:
+        return True
+    catalog_etag = get_onedrive_item_etag(CATALOG_FILE_PATH)
+    if catalog_etag is None:
+        return False
+    if catalog_etag:
+        state["done"] = True
+        return True
+    legacy_courses = load_journaled_document(LEGACY_COURSES_FILE_PATH, "course_id", strict=True)
+    legacy_homework = load_journaled_document(LEGACY_HOMEWORK_FILE_PATH, "homework_id", strict=True)
+    if legacy_courses is None or legacy_homework is None:
+        return False
+    if not legacy_courses:
+        state["done"] = True
+        return True
+    memberships = {}
+    with UnitOfWork() as uow:
+        for course in legacy_courses:
+            course_id = course['course_id']
+            students = course.get('student_emails', [])
+            uow.put(course_shard_path(course_id, "roster"), [{"email": e} for e in students])
+            uow.put(course_shard_path(course_id, "homework"),
+                    [hw for hw in legacy_homework if hw.get('course_id') == course_id])
+            for email in students:
+                memberships.setdefault(email, []).append({"course_id": course_id})
+        for email, entries in memberships.items():
+            uow.put(membership_path(email), entries)
+    if not uow.succeeded:
+        return False
+    catalog = [{k: c.get(k) for k in ("course_id", "course_name", "teacher_email", "join_code")} for c in legacy_courses]
+    # 412 表示其他副本已先写入目录，同样视为迁移完成
+    if not save_onedrive_data(CATALOG_FILE_PATH, catalog, etag="") and not get_onedrive_item_etag(CATALOG_FILE_PATH):
+        return False
+    state["done"] = True
+    return True
+
 @st.cache_data(ttl=60)
-def get_all_courses():
-    courses = get_onedrive_data(COURSES_FILE_PATH)
-    return courses if courses else []
+def get_course_catalog():
+    migrate_legacy_global_data()
+    return load_journaled_document(CATALOG_FILE_PATH, "course_id")
 
-def save_all_courses(courses_data):
-    return save_onedrive_data(COURSES_FILE_PATH, courses_data)
+def append_catalog_changes(ops):
+    return append_journal_record(CATALOG_FILE_PATH, ops)
+
+@st.cache_data(ttl=60)
+def get_course_roster(course_id):
+    return [entry['email'] for entry in load_journaled_document(course_shard_path(course_id, "roster"), "email")]
 
 @st.cache_data(ttl=60)
-def get_all_homework():
-    homework = get_onedrive_data(HOMEWORK_FILE_PATH)
-    return homework if homework else []
+def get_student_course_ids(student_email):
+    return [entry['course_id'] for entry in load_journaled_document(membership_path(student_email), "course_id")]
 
-def save_all_homework(homework_data):
-    return save_onedrive_data(HOMEWORK_FILE_PATH, homework_data)
+def with_roster(catalog_entry):
+    return {**catalog_entry, "student_emails": get_course_roster(catalog_entry['course_id'])}
 
 def get_teacher_courses(teacher_email):
-    return [c for c in get_all_courses() if c.get('teacher_email') == teacher_email]
+    return [with_roster(c) for c in get_course_catalog() if c.get('teacher_email') == teacher_email]
 
 def get_student_courses(student_email):
-    return [c for c in get_all_courses() if student_email in c.get('student_emails', [])]
+    course_ids = set(get_student_course_ids(student_email))
+    return [with_roster(c) for c in get_course_catalog() if c['course_id'] in course_ids]
 
+def add_student_to_course(course_id, student_email) -> bool:
+    with UnitOfWork() as uow:
+        uow.append(course_shard_path(course_id, "roster"), [{"op": "put", "id": student_email, "value": {"email": student_email}}])
+        uow.append(membership_path(student_email), [{"op": "put", "id": course_id, "value": {"course_id": course_id}}])
+    return uow.succeeded
+
+def remove_student_from_course(course_id, student_email) -> bool:
+    with UnitOfWork() as uow:
+        uow.append(course_shard_path(course_id, "roster"), [{"op": "delete", "id": student_email}])
+        uow.append(membership_path(student_email), [{"op": "delete", "id": course_id}])
+    return uow.succeeded
+
+@st.cache_data(ttl=60)
 def get_course_homework(course_id):
-    all_hw = get_all_homework()
-    return [hw for hw in all_hw if hw.get('course_id') == course_id]
+    return load_journaled_document(course_shard_path(course_id, "homework"), "homework_id")
 
-@st.cache_data(ttl=30)
-def get_homework(homework_id):
-    all_hw = get_all_homework()
-    return next((hw for hw in all_hw if hw.get('homework_id') == homework_id), None)
+def append_homework_changes(course_id, ops):
+    return append_journal_record(course_shard_path(course_id, "homework"), ops)
+
+def get_homework(course_id, homework_id):
+    return next((hw for hw in get_course_homework(course_id) if hw.get('homework_id') == homework_id), None)
 
 @st.cache_data(ttl=30)
 def get_submissions_for_homework(homework_id):
-    submissions = []
-    try:
-        token = get_ms_graph_token()
-        if not token:
-            return []
-        headers = {"Authorization": f"Bearer {token}"}
-        path = f"{BASE_ONEDRIVE_PATH}/submissions/{homework_id}:/children"
-        response = onedrive_api_request('get', path, headers)
-        if response is None or response.status_code == 404:
-            return []
-        response.raise_for_status()
-        student_folders = response.json().get('value', [])
-        for folder in student_folders:
-            submission_path = f"{BASE_ONEDRIVE_PATH}/submissions/{homework_id}/{folder['name']}/submission.json"
-            submission_data = get_onedrive_data(submission_path)
-            if submission_data:
-                submissions.append(submission_data)
-    except Exception:
-        return []
-    return submissions
+    student_folders = list_onedrive_children(f"{BASE_ONEDRIVE_PATH}/submissions/{homework_id}") or []
+    paths = [f"{BASE_ONEDRIVE_PATH}/submissions/{homework_id}/{folder['name']}/submission.json" for folder in student_folders]
+    return [submission for submission in fetch_onedrive_many(paths) if submission]
+
+def student_submission_path(homework_id, student_email):
+    return f"{BASE_ONEDRIVE_PATH}/submissions/{homework_id}/{get_email_hash(student_email)}/submission.json"
 
 def get_student_submission(homework_id, student_email):
-    path = f"{BASE_ONEDRIVE_PATH}/submissions/{homework_id}/{get_email_hash(student_email)}/submission.json"
-    return get_onedrive_data(path)
+    return get_onedrive_data(student_submission_path(homework_id, student_email))
+
+def get_student_submissions(homework_ids, student_email):
+    """并发读取学生在多份作业中的提交，返回 {homework_id: submission 或 None}。"""
+    homework_ids = list(homework_ids)
+    return dict(zip(homework_ids, fetch_onedrive_many(student_submission_path(hw_id, student_email) for hw_id in homework_ids)))
 
 @st.cache_data(ttl=120)
 def get_student_profiles_for_course(student_emails):
-    profiles = {}
-    for email in student_emails:
-        profile = get_user_profile(email)
-        if profile:
-            profiles[email] = profile
-    return profiles
+    profiles = fetch_onedrive_many(user_profile_path(email) for email in student_emails)
+    return {email: profile for email, profile in zip(student_emails, profiles) if profile}
 
 # ---------------- 操作逻辑 ----------------
 
 def handle_delete_course(course_id_to_delete):
     with st.spinner("正在删除课程及其所有相关数据..."):
-        all_hw = get_all_homework()
-        course_hws = [hw for hw in all_hw if hw.get('course_id') == course_id_to_delete]
-        for hw in course_hws:
-            submission_folder_path = f"{BASE_ONEDRIVE_PATH}/submissions/{hw['homework_id']}"
-            delete_onedrive_item(submission_folder_path)
-        remaining_hw = [hw for hw in all_hw if hw.get('course_id') != course_id_to_delete]
-        save_all_homework(remaining_hw)
-        all_courses = get_all_courses()
-        remaining_courses = [c for c in all_courses if c.get('course_id') != course_id_to_delete]
-        save_all_courses(remaining_courses)
-        st.cache_data.clear()
-        st.success("课程及所有相关数据已成功删除。")
+        with UnitOfWork() as uow:
+            for hw in get_course_homework(course_id_to_delete):
+                uow.delete(f"{BASE_ONEDRIVE_PATH}/submissions/{hw['homework_id']}")
+            uow.delete(f"{BASE_ONEDRIVE_PATH}/courses/{course_id_to_delete}")
+        # 目录条目最后删除：上面的删除失败时课程仍可见，可以再次删除
+        if uow.succeeded and append_catalog_changes([{"op": "delete", "id": course_id_to_delete}]):
+            st.cache_data.clear()
+            st.success("课程及所有相关数据已成功删除。")
+        else:
+            st.error("部分数据删除失败，请重试。")
         time.sleep(2)
 
+# ---------------- 后台存储维护 ----------------
+
+MAINTENANCE_INTERVAL_SECONDS = 6 * 60 * 60   # 两次清理之间的间隔
+MAINTENANCE_FIRST_RUN_DELAY = 5 * 60         # 进程启动后延迟首次运行，避开启动高峰
+MAINTENANCE_IO_BUDGET = 400                  # 单次运行最多发起的 Graph 请求数
+MAINTENANCE_IO_PAUSE_SECONDS = 0.25          # 每次请求之间的停顿，避免挤占用户流量
+ORPHAN_GRACE_SECONDS = 24 * 60 * 60          # 新上传的附件可能尚未写入 submission.json，宽限期内不删除
+
+class MaintenanceBudgetExhausted(Exception):
+    pass
+
+def _graph_timestamp(value) -> float:
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except Exception:
+        return time.time()
+
+class StorageMaintenance:
+    """
+    定期清理：
+    - codes.json / sessions.json / revoked_sessions.json 中已过期的条目；
+    - submissions/ 下不再被任何 submission.json 引用的附件、已删除作业残留的文件夹；
+    - blobs/ 中不再被任何提交引用的内容寻址附件。
+    每次运行的请求数受 MAINTENANCE_IO_BUDGET 限制，未扫描完的部分下次从断点继续。
+
+    blobs 采用标记-清除：先在一个扫描周期内遍历全部提交收集引用（mark），周期结束后再清理
+    blobs（sweep）。只删除修改时间早于“周期开始 - 宽限期”的 blob；周期内新提交引用的 blob
+    在提交时会被上传或刷新修改时间（put_if_absent），因此不会被误删。
+    标记阶段任何读取失败（文件夹列表、submission.json）都视为引用未知：该文件夹不做任何删除，
+    并放弃本周期的 blob 清理。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._io_calls = 0
+        self._phase = "mark"
+        self._cursor = None          # 当前阶段已处理到的文件夹名
+        self._cycle_started_at = 0.0
+        self._blob_refs = set()
+        self._mark_incomplete = False  # 标记阶段有读取失败时，本周期不清理 blobs（出错的文件夹本身也不清理）
+        self._hw_scan = None           # 本周期汇总已知作业 ID 的进度：{"pending": [课程ID], "known": set(), "failed": bool}
+        self.running = False
+        self.last_report = None
+        threading.Thread(target=self._loop, name="storage-maintenance", daemon=True).start()
+
+    def _loop(self):
+        delay = MAINTENANCE_FIRST_RUN_DELAY
+        while True:
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            self.run_once()
+            delay = MAINTENANCE_INTERVAL_SECONDS
+
+    def trigger(self):
+        """唤醒后台线程立即运行一次（不阻塞当前页面）。"""
+        self._wakeup.set()
+
+    def _io(self):
+        if self._io_calls >= MAINTENANCE_IO_BUDGET:
+            raise MaintenanceBudgetExhausted()
+        self._io_calls += 1
+        time.sleep(MAINTENANCE_IO_PAUSE_SECONDS)
+
+    def _counted(self, fn, *args, **kwargs):
+        """执行一次可能发出多个 Graph 请求的操作，按实际请求数计入预算。"""
+        self._io()
+        counter = [0]
+        token = _graph_request_counter.set(counter)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _graph_request_counter.reset(token)
+            self._io_calls += max(counter[0] - 1, 0)
+
+    def _prune_expired(self, file_name, get_expiry) -> int:
+        """条件写入（见 update_global_data），清理期间新签发的验证码、新吊销的会话不会被覆盖。"""
+        removed = 0
+
+        def prune(data):
+            nonlocal removed
+            now = time.time()
+            kept = {k: v for k, v in data.items() if get_expiry(v) > now}
+            removed = len(data) - len(kept)
+            return kept if removed else None
+
+        return removed if self._counted(update_global_data, file_name, prune) else 0
+
+    def _sweep_student_folder(self, folder_path, report):
+        self._io()
+        files = list_onedrive_children(folder_path)
+        if files is None:
+            self._mark_incomplete = True
+        if not files:
+            return
+        self._io()
+        submission = get_onedrive_data(f"{folder_path}/submission.json", allow_stale=False)
+        if submission is None:
+            if any(item['name'] == "submission.json" for item in files):
+                # 提交记录存在但读取失败：无法判断哪些旧附件仍被引用，本次跳过该文件夹
+                self._mark_incomplete = True
+                return
+            submission = {}
+        referenced = {"submission.json"}
+        for answer in submission.get('answers', {}).values():
+            for attachment in answer.get('attachments', []):
+                if isinstance(attachment, dict):
+                    self._blob_refs.add(blob_file_name(attachment['sha256'], attachment['ext']))
+                else:
+                    referenced.add(attachment)
+        cutoff = time.time() - ORPHAN_GRACE_SECONDS
+        for item in files:
+            if item['name'] in referenced or _graph_timestamp(item.get('lastModifiedDateTime')) > cutoff:
+                continue
+            self._io()
+            if delete_onedrive_item(f"{folder_path}/{item['name']}"):
+                report['orphans_deleted'] += 1
+                report['bytes_reclaimed'] += item.get('size', 0)
+
+    def _load_strict(self, doc_path, key_field):
+        """严格读取变更日志文档，按实际发出的请求数（日志列表、eTag、快照、各条记录）计入预算。"""
+        return self._counted(load_journaled_document, doc_path, key_field, strict=True)
+
+    def _known_homework_ids(self):
+        """
+        汇总所有课程分片中的作业 ID。每个标记周期只汇总一次，课程较多时跨多次运行分批完成，进度保存在
+        self._hw_scan 中；任一分片读取失败返回 None，此时本周期只清理单个提交内的孤立附件。
+        """
+        if self._hw_scan is None:
+            catalog = self._load_strict(CATALOG_FILE_PATH, "course_id")
+            self._hw_scan = {"pending": [c['course_id'] for c in catalog or []], "known": set(), "failed": not catalog}
+        scan = self._hw_scan
+        while scan["pending"] and not scan["failed"]:
+            course_hw = self._load_strict(course_shard_path(scan["pending"][-1], "homework"), "homework_id")
+            if course_hw is None:
+                scan["failed"] = True
+                break
+            scan["known"].update(hw['homework_id'] for hw in course_hw)
+            scan["pending"].pop()
+        return None if scan["failed"] else scan["known"]
+
+    def _sweep_submissions(self, report):
+        if self._phase == "blobs":
+            self._sweep_blobs(report)
+            return
+        if self._cursor is None:
+            self._cycle_started_at = time.time()
+            self._blob_refs = set()
+            self._mark_incomplete = False
+            self._hw_scan = None
+            self._cursor = ""
+        self._io()
+        homework_folders = list_onedrive_children(f"{BASE_ONEDRIVE_PATH}/submissions")
+        if homework_folders is None:
+            return
+        known_hw_ids = self._known_homework_ids() if homework_folders else None
+        for hw_folder in sorted(homework_folders, key=lambda item: item['name']):
+            if hw_folder['name'] <= self._cursor:
+                continue
+            hw_path = f"{BASE_ONEDRIVE_PATH}/submissions/{hw_folder['name']}"
+            if known_hw_ids is not None and hw_folder['name'] not in known_hw_ids:
+                if _graph_timestamp(hw_folder.get('lastModifiedDateTime')) < time.time() - ORPHAN_GRACE_SECONDS:
+                    self._io()
+                    if delete_onedrive_item(hw_path):
+                        report['orphans_deleted'] += hw_folder.get('folder', {}).get('childCount', 1)
+                        report['bytes_reclaimed'] += hw_folder.get('size', 0)
+            else:
+                self._io()
+                student_folders = list_onedrive_children(hw_path)
+                if student_folders is None:
+                    self._mark_incomplete = True
+                for student_folder in student_folders or []:
+                    self._sweep_student_folder(f"{hw_path}/{student_folder['name']}", report)
+            self._cursor = hw_folder['name']
+        if self._mark_incomplete:
+            # 引用集合不完整，放弃本周期的 blob 清理，下次重新标记
+            self._cursor = None
+            return
+        self._phase, self._cursor = "blobs", ""
+        self._sweep_blobs(report)
+
+    def _sweep_blobs(self, report):
+        self._io()
+        prefixes = list_onedrive_children(BLOB_STORE_PATH)
+        if prefixes is None:
+            return
+        cutoff = self._cycle_started_at - ORPHAN_GRACE_SECONDS
+        for prefix in sorted(prefixes, key=lambda item: item['name']):
+            if prefix['name'] <= self._cursor:
+                continue
+            self._io()
+            for item in list_onedrive_children(f"{BLOB_STORE_PATH}/{prefix['name']}") or []:
+                stamps = [item.get('lastModifiedDateTime'), item.get('fileSystemInfo', {}).get('lastModifiedDateTime')]
+                modified = max(_graph_timestamp(stamp) for stamp in stamps if stamp) if any(stamps) else time.time()
+                if item['name'] in self._blob_refs or modified > cutoff:
+                    continue
+                self._io()
+                if delete_onedrive_item(f"{BLOB_STORE_PATH}/{prefix['name']}/{item['name']}"):
+                    report['orphans_deleted'] += 1
+                    report['bytes_reclaimed'] += item.get('size', 0)
+            self._cursor = prefix['name']
+        # 本轮清理完成，下次运行开始新的标记周期
+        self._phase, self._cursor = "mark", None
+
+    def run_once(self):
+        if not self._lock.acquire(blocking=False):
+            return self.last_report
+        self.running = True
+        self._io_calls = 0
+        report = {"started_at": datetime.utcnow().isoformat() + "Z", "codes_pruned": 0, "sessions_pruned": 0,
+                  "orphans_deleted": 0, "bytes_reclaimed": 0, "complete": True}
+        try:
+            report['codes_pruned'] = self._prune_expired("codes", lambda v: v.get("expires_at", 0))
+            report['sessions_pruned'] = (self._prune_expired("sessions", lambda v: v.get("expires_at", 0))
+                                         + self._prune_expired(REVOKED_SESSIONS_FILE, lambda v: v))
+            self._sweep_submissions(report)
+        except MaintenanceBudgetExhausted:
+            report['complete'] = False
+        except Exception as e:
+            report.update(complete=False, error=str(e))
+        finally:
+            report['io_calls'] = self._io_calls
+            report['finished_at'] = datetime.utcnow().isoformat() + "Z"
+            self.last_report = report
+            self.running = False
+            self._lock.release()
+        return report
+
+@st.cache_resource
+def get_storage_maintenance():
+    """进程级单例：首次调用时启动后台清理线程，所有会话共享。"""
+    return StorageMaintenance()
+
+def render_storage_maintenance_panel():
+    maintenance = get_storage_maintenance()
+    with st.expander("🧹 存储维护"):
+        report = maintenance.last_report
+        if maintenance.running:
+            st.info("清理任务正在后台运行...")
+        elif report:
+            st.write(f"上次运行: {report['finished_at']}（{'已完成' if report['complete'] else '未扫描完，下次继续'}）")
+            st.write(f"清理过期验证码 {report['codes_pruned']} 条，过期会话 {report['sessions_pruned']} 条，"
+                     f"孤立附件 {report['orphans_deleted']} 个，回收 {report['bytes_reclaimed'] / 1024 / 1024:.2f} MB")
+            if report.get('error'):
+                st.error(f"运行出错: {report['error']}")
+        else:
+            st.write("后台清理任务尚未运行。")
+        if st.button("立即在后台运行", key="run_maintenance", disabled=maintenance.running, use_container_width=True):
+            maintenance.trigger()
+            st.toast("已触发后台清理。")
+
+def render_startup_timings_panel():
+    timings = get_startup_timings()
+    with st.expander("⏱️ 启动耗时"):
+        if not timings:
+            st.write("暂无记录。")
+        for name, seconds in timings.items():
+            st.write(f"{name}: {seconds * 1000:.0f} ms")
+
 # ---------------- 教师端 ----------------
 
 def render_teacher_dashboard(teacher_email):
@@ -451,10 +2621,9 @@ def render_teacher_dashboard(teacher_email):
                     if course_name in teacher_course_names:
                         st.error("您已经创建过同名课程，请使用其他名称。")
                     else:
-                        all_courses = get_all_courses()
                         course_id = str(uuid.uuid4())
                         # 邀请码唯一生成（6位十六进制）
-                        existing_codes = {c.get('join_code') for c in all_courses}
+                        existing_codes = {c.get('join_code') for c in get_course_catalog()}
                         while True:
                             join_code = secrets.token_hex(3).upper()
                             if join_code not in existing_codes:
@@ -463,17 +2632,21 @@ def render_teacher_dashboard(teacher_email):
                             "course_id": course_id,
                             "course_name": course_name,
                             "teacher_email": teacher_email,
-                            "join_code": join_code,
-                            "student_emails": []
+                            "join_code": join_code
                         }
-                        all_courses.append(new_course)
-                        if save_all_courses(all_courses):
+                        if append_catalog_changes([{"op": "put", "id": course_id, "value": new_course}]):
                             st.success(f"课程 '{course_name}' 创建成功！加入代码: **{join_code}**")
                             st.cache_data.clear()
                         else:
                             st.error("课程创建失败。")
+    # 存储维护会清理全部课程的数据，运行状态也是全局的，只对管理员显示
+    if is_admin(teacher_email):
+        render_storage_maintenance_panel()
+        render_startup_timings_panel()
     st.subheader("我的课程列表")
-    if not teacher_courses:
+    if not teacher_courses and is_storage_degraded():
+        st.warning("暂时无法加载课程列表，请稍后刷新。")
+    elif not teacher_courses:
         st.info("您还没有创建任何课程。请在上方创建您的第一门课程。")
     else:
         for course in teacher_courses:
@@ -514,7 +2687,9 @@ def render_course_management_view(course, teacher_email):
     with tab1:
         st.subheader("已发布的作业")
         course_homeworks = get_course_homework(course['course_id'])
-        if not course_homeworks:
+        if not course_homeworks and is_storage_degraded():
+            st.warning("暂时无法加载作业列表，请稍后刷新。")
+        elif not course_homeworks:
             st.info("本课程暂无作业。")
         else:
             for hw in course_homeworks:
@@ -524,9 +2699,7 @@ def render_course_management_view(course, teacher_email):
                         for i, q in enumerate(hw['questions']):
                             st.write(f"**第{i+1}题 ({q.get('type', 'text')}):** {q['question']}")
                     if st.button("删除此作业", key=f"del_{hw['homework_id']}", type="primary", use_container_width=True):
-                        all_hw = get_all_homework()
-                        new_hw_list = [h for h in all_hw if h['homework_id'] != hw['homework_id']]
-                        if save_all_homework(new_hw_list):
+                        if append_homework_changes(course['course_id'], [{"op": "delete", "id": hw['homework_id']}]):
                             delete_onedrive_item(f"{BASE_ONEDRIVE_PATH}/submissions/{hw['homework_id']}")
                             st.success("作业已删除！")
                             st.cache_data.clear()
@@ -539,71 +2712,68 @@ def render_course_management_view(course, teacher_email):
         st.subheader("用AI生成并发布新作业")
         topic = st.text_input("作业主题", key=f"topic_{course['course_id']}")
         details = st.text_area("具体要求 (例如: 模拟网络故障排除、设计一个营销活动方案等)", key=f"details_{course['course_id']}")
-        if st.button("AI 生成作业题目", key=f"gen_hw_{course['course_id']}", use_container_width=True):
-            if 'editable_homework' in st.session_state:
-                del st.session_state.editable_homework
-            if 'generated_homework' in st.session_state:
-                del st.session_state.generated_homework
+        gen_cols = st.columns([3, 2])
+        generate = gen_cols[0].button(f"AI 生成作业题目（{HOMEWORK_CANDIDATE_COUNT} 份候选）", key=f"gen_hw_{course['course_id']}", use_container_width=True)
+        regenerate = gen_cols[1].button("🔄 忽略缓存重新生成", key=f"regen_hw_{course['course_id']}", use_container_width=True)
+        if generate or regenerate:
+            st.session_state.pop('editable_homework', None)
+            st.session_state.pop('homework_candidates', None)
+            st.session_state.homework_candidates_topic = topic
             if topic and details:
-                with st.spinner("AI正在为您生成题目..."):
-                    prompt = f"""# 角色
-你是一位资深的教育专家与出题人，能够根据不同学科的特点，设计出高质量、有深度的作业题目。
-
-# 任务
-为课程“{course['course_name']}”创建一份关于“{topic}”的作业。作业要求如下：{details}
-
-# 核心指令
-1.  **分析科目性质**: 首先，分析课程“{course['course_name']}”和主题“{topic}”的性质。判断其是偏向于**实践技能**（如编程、网络、设计、营销策划）还是**理论知识**（如数学、物理、文学、历史）。
-2.  **匹配出题策略**:
-    * 对于**实践技能型**的科目，优先设计**场景化、任务导向**的实操题，要求学生动手操作、解决问题或制定方案。
-    * 对于**理论知识型**的科目，设计能够检验学生**概念理解、逻辑推理、分析应用能力**的题目。即使是理论题，也应尽量联系实际背景或设计巧妙的问题情境，避免死记硬背。
-3.  **明确任务要求**: 无论哪种类型的题目，都必须有明确的考核目标，并清晰地描述要求学生完成的任务（如“请证明”、“请分析”、“请列出步骤”、“请编写代码”等）,题目要覆盖所有要掌握的知识点，既有单个知识点，也有组合多个知识点的考察。
-
-# 输出格式要求
-你必须严格遵循以下JSON格式，不包含任何解释性文字或Markdown标记。
-
-**JSON格式模板 (包含不同类型实训题示例):**
-{{
-    "title": "{topic} - 综合能力作业",
-    "questions": [
-        {{
-            "id": "q0",
-            "type": "text",
-            "question": "【实践-网络】假设你是一家公司的网络管理员，有员工报告无法访问内部文件服务器。【任务】请详细列出你从接到报告到解决问题的完整故障排查步骤。"
-        }},
-        {{
-            "id": "q1",
-            "type": "text",
-            "question": "【理论-数学】在微积分中，导数代表了函数在某一点的瞬时变化率。【任务】请利用极限的定义，证明函数 f(x) = x² 的导数是 f'(x) = 2x。"
-        }},
-        {{
-            "id": "q2",
-            "type": "text",
-            "question": "【理论-文学】杜甫被誉为“诗圣”，其诗歌深刻反映了唐朝安史之乱时期的社会现实。【任务】请选择杜甫的《春望》或《石壕吏》，分析其如何通过具体的意象和叙事来体现“诗史”的特点。"
-        }},
-        {{
-            "id": "q3",
-            "type": "multiple_choice",
-            "question": "【实践-编程】在处理一个大型数据集时，你发现一个关键的计算函数执行效率低下，成为了程序的瓶颈。【问题】从算法优化的角度出发，你应该最优先考虑的改进方向是什么？",
-            "options": ["升级服务器硬件", "将Python代码替换为C++", "分析算法的时间复杂度，并寻找更高效的算法替代", "增加更多的日志输出来调试"]
-        }}
-    ]
-}}
-"""
-                    response_text = call_gemini_api(prompt)
-                    if response_text:
-                        st.session_state.generated_homework = response_text
-                        st.success("作业已生成！请在下方编辑和发布。")
+                cached = None if regenerate else get_onedrive_data(generation_cache_path(course['course_name'], topic, details))
+                if cached and cached.get('candidates'):
+                    st.session_state.homework_candidates = cached['candidates']
+                    st.toast("已使用相同主题与要求的历史生成结果。")
+                else:
+                    placeholders = [st.empty() for _ in range(HOMEWORK_CANDIDATE_COUNT)]
+                    for placeholder in placeholders:
+                        placeholder.info("⏳ AI正在生成候选方案...")
+                    candidates = [None] * HOMEWORK_CANDIDATE_COUNT
+                    for index, homework_json in stream_homework_candidates(course['course_name'], topic, details):
+                        candidates[index] = homework_json
+                        if homework_json:
+                            placeholders[index].success(f"**方案 {index + 1}：{homework_json.get('title', '')}**（{len(homework_json.get('questions', []))} 题）")
+                        else:
+                            placeholders[index].error(f"方案 {index + 1} 生成失败。")
+                    candidates = [c for c in candidates if c]
+                    if candidates:
+                        save_onedrive_data(generation_cache_path(course['course_name'], topic, details), {
+                            "topic": topic, "details": details, "candidates": candidates,
+                            "generated_at": datetime.utcnow().isoformat() + "Z",
+                        })
+                        st.session_state.homework_candidates = candidates
+                        st.rerun()
+                    else:
+                        st.error("作业生成失败，请稍后重试。")
             else:
                 st.warning("请输入作业主题和具体要求。")
 
-        # 转入可编辑
-        if 'generated_homework' in st.session_state and 'editable_homework' not in st.session_state:
-            json_data = parse_ai_json(st.session_state.generated_homework)
-            if json_data:
-                st.session_state.editable_homework = json_data
-            if 'generated_homework' in st.session_state:
-                del st.session_state.generated_homework
+        with st.expander("📚 题库：复用本课程该主题下已发布的题目（不调用 AI）"):
+            library = get_question_library(course['course_id'], topic) if topic else []
+            if not topic:
+                st.caption("请先在上方输入作业主题。")
+            elif not library:
+                st.caption("该主题下暂无题目，发布作业后其题目会自动加入题库。")
+            else:
+                picked = st.multiselect("选择题目", options=list(range(len(library))),
+                                        format_func=lambda i: library[i]['question'][:80],
+                                        key=f"library_pick_{course['course_id']}")
+                if st.button("用所选题目组成作业", key=f"library_use_{course['course_id']}", disabled=not picked, use_container_width=True):
+                    select_editable_homework({"title": f"{topic} - 综合能力作业",
+                                              "questions": [{**library_question(library[i]), "id": f"q{n}"} for n, i in enumerate(picked)]},
+                                             topic)
+                    st.rerun()
+
+        if st.session_state.get('homework_candidates'):
+            st.markdown("#### 候选方案")
+            for index, candidate in enumerate(st.session_state.homework_candidates):
+                with st.container(border=True):
+                    st.markdown(f"**方案 {index + 1}：{candidate.get('title', '')}**")
+                    for n, q in enumerate(candidate.get('questions', [])):
+                        st.caption(f"{n + 1}. {q.get('question', '')}")
+                    if st.button(f"选用方案 {index + 1}", key=f"pick_candidate_{course['course_id']}_{index}", use_container_width=True):
+                        select_editable_homework(candidate, st.session_state.get('homework_candidates_topic'))
+                        st.rerun()
 
         # 编辑并发布
         if 'editable_homework' in st.session_state:
@@ -630,16 +2800,20 @@ def render_course_management_view(course, teacher_email):
                                 opts_str = st.session_state[f"q_opts_{i}"]
                                 current_q['options'] = [opt.strip() for opt in opts_str.split(',') if opt.strip()]
                             final_questions.append(current_q)
-                        all_hw = get_all_homework()
-                        all_hw.append({
+                        new_hw = {
                             "homework_id": str(uuid.uuid4()),
                             "course_id": course['course_id'],
                             "title": edited_title,
                             "questions": final_questions
-                        })
-                        if save_all_homework(all_hw):
+                        }
+                        if append_homework_changes(course['course_id'], [{"op": "put", "id": new_hw['homework_id'], "value": new_hw}]):
+                            generation_topic = st.session_state.get('editable_homework_topic')
+                            if generation_topic:
+                                add_to_question_library(course['course_id'], generation_topic, new_hw)
                             st.success("作业已成功发布！")
                             del st.session_state.editable_homework
+                            st.session_state.pop('editable_homework_topic', None)
+                            st.session_state.pop('homework_candidates', None)
                             st.cache_data.clear()
                             time.sleep(1)
                             st.rerun()
@@ -657,11 +2831,8 @@ def render_course_management_view(course, teacher_email):
                 cols = st.columns([4, 1])
                 cols[0].write(f"- {student_email}")
                 if cols[1].button("移除", key=f"remove_{get_email_hash(student_email)}", type="primary", use_container_width=True):
-                    all_courses = get_all_courses()
-                    target_course = next((c for c in all_courses if c['course_id'] == course['course_id']), None)
-                    if target_course and student_email in target_course['student_emails']:
-                        target_course['student_emails'].remove(student_email)
-                        if save_all_courses(all_courses):
+                    if student_email in course.get('student_emails', []):
+                        if remove_student_from_course(course['course_id'], student_email):
                             st.success(f"已移除 {student_email}")
                             st.cache_data.clear()
                             time.sleep(1)
@@ -672,43 +2843,66 @@ def render_course_management_view(course, teacher_email):
     # --- 成绩册 ---
     with tab3:
         st.subheader("成绩册")
+        st.session_state.per_question_grading = st.toggle(
+            "逐题并行批改", value=st.session_state.per_question_grading, key=f"pq_toggle_{course['course_id']}",
+            help="每道题单独并发批改，回答未变的题目复用上次结果。")
         homework_list = get_course_homework(course['course_id'])
+        if not homework_list and is_storage_degraded():
+            st.warning("暂时无法加载作业列表，请稍后刷新。")
+            return
         if not homework_list:
             st.info("本课程还没有已发布的作业。")
             return
+        gradebook = get_course_gradebook(course['course_id'])
+        student_profiles = get_student_profiles_for_course(tuple(course.get('student_emails', [])))
+        if st.button("🔄 重建成绩册", key=f"rebuild_gradebook_{course['course_id']}", help="成绩与提交不一致时，从全部提交重新生成成绩册。"):
+            with st.spinner("正在从全部提交重建成绩册..."):
+                if rebuild_gradebook(course['course_id']):
+                    st.cache_data.clear()
+                    st.rerun()
+                else:
+                    st.error("重建失败，请稍后重试。")
         for hw in homework_list:
             with st.expander(f"**{hw['title']}**", expanded=True):
-                submissions = get_submissions_for_homework(hw['homework_id'])
-                submissions_map = {sub['student_email']: sub for sub in submissions}
-                pending_subs = [s for s in submissions if s.get('status') == 'submitted']
-                graded_subs_for_remedial = [s for s in submissions if s.get('status') == 'feedback_released' and s.get('final_grade', 100) < 80]
+                hw_cells = {email: cell for (hw_id, email), cell in gradebook.items() if hw_id == hw['homework_id']}
+                pending_count = sum(1 for c in hw_cells.values() if c.get('status') == 'submitted')
+                remedial_count = sum(1 for c in hw_cells.values()
+                                     if c.get('status') == 'feedback_released' and (c.get('final_grade') if c.get('final_grade') is not None else 100) < 80)
 
                 action_cols = st.columns(2)
                 with action_cols[0]:
-                    if st.button(f"🤖 一键AI批改并反馈 ({len(pending_subs)}份)", key=f"batch_grade_review_{hw['homework_id']}", disabled=not pending_subs, use_container_width=True):
+                    if st.button(f"🤖 一键AI批改并反馈 ({pending_count}份)", key=f"batch_grade_review_{hw['homework_id']}", disabled=not pending_count, use_container_width=True):
+                        submissions = get_submissions_for_homework(hw['homework_id'])
+                        pending_subs = [s for s in submissions if s.get('status') == 'submitted']
                         with st.spinner(f"正在一键处理 {len(pending_subs)} 份作业..."):
                             progress_bar = st.progress(0, text="开始处理...")
-                            for i, sub in enumerate(pending_subs):
-                                progress_bar.progress((i + 1) / len(pending_subs), text=f"处理中: {sub['student_email']}")
-                                try:
-                                    all_answers = sub.get('answers', {})
-                                    text_data_part = f"【题目】: {json.dumps(hw['questions'], ensure_ascii=False)}\n【回答】: {json.dumps(all_answers, ensure_ascii=False)}"
-                                    api_prompt_parts = [AI_GRADING_PROMPT, text_data_part]
-                                    for q_key, answer_data in all_answers.items():
-                                        if answer_data.get('attachments'):
-                                            for filename in answer_data['attachments']:
-                                                file_path = f"{BASE_ONEDRIVE_PATH}/submissions/{hw['homework_id']}/{get_email_hash(sub['student_email'])}/{filename}"
-                                                file_bytes = get_onedrive_data(file_path, is_json=False)
-                                                if file_bytes:
-                                                    api_prompt_parts.append(f"--- 附件 '{filename}' ---")
-                                                    mime_type = get_mime_type(filename)
-                                                    if mime_type and mime_type.startswith('image/'):
-                                                        api_prompt_parts.append(Image.open(io.BytesIO(file_bytes)))
-                                                    elif mime_type:
-                                                        api_prompt_parts.append({'inline_data': {'data': file_bytes, 'mime_type': mime_type}})
-                                    ai_result_text = call_gemini_api(api_prompt_parts)
-                                    if ai_result_text:
-                                        ai_result = parse_ai_json(ai_result_text)
+                            released_subs = []
+                            # 内容完全相同的提交直接复用已有的 AI 批改结果，不再调用模型
+                            graded_by_fingerprint = {submission_fingerprint(s.get('answers', {})): s
+                                                     for s in submissions if s.get('ai_detailed_grades')}
+                            with ai_job(AI_PRIORITY_BATCH, course['course_id']):
+                                for i, sub in enumerate(pending_subs):
+                                    progress_bar.progress((i + 1) / len(pending_subs), text=f"处理中: {sub['student_email']}")
+                                    try:
+                                        sub_path = f"{BASE_ONEDRIVE_PATH}/submissions/{sub['homework_id']}/{get_email_hash(sub['student_email'])}/submission.json"
+                                        fingerprint = submission_fingerprint(sub.get('answers', {}))
+                                        identical = graded_by_fingerprint.get(fingerprint)
+                                        if identical:
+                                            ai_result = {"overall_grade": identical.get('ai_grade'),
+                                                         "overall_feedback": identical.get('ai_feedback'),
+                                                         "detailed_grades": identical.get('ai_detailed_grades')}
+                                            sub['ai_reused_from'] = identical['submission_id']
+                                        elif st.session_state.get('per_question_grading'):
+                                            ai_result, question_results, failed_q = grade_submission_per_question(hw, sub)
+                                            sub['ai_question_results'] = question_results
+                                            if failed_q:
+                                                # 保留已成功的逐题结果，下次只重批失败的题目
+                                                st.toast(f"⚠️ {sub['student_email']} 第 {', '.join(str(i + 1) for i in failed_q)} 题批改失败，已跳过")
+                                                save_onedrive_data(sub_path, sub)
+                                                ai_result = None
+                                        else:
+                                            grading_model, api_prompt_parts = build_grading_request(hw, sub['student_email'], sub.get('answers', {}))
+                                            ai_result = call_gemini_json(api_prompt_parts, GRADING_RESPONSE_SCHEMA, model=grading_model)
                                         if ai_result:
                                             sub.update({
                                                 'ai_grade': ai_result.get('overall_grade'),
@@ -716,11 +2910,17 @@ def render_course_management_view(course, teacher_email):
                                                 'ai_detailed_grades': ai_result.get('detailed_grades'),
                                                 'status': "feedback_released",
                                                 'final_grade': ai_result.get('overall_grade'),
-                                                'final_feedback': ai_result.get('overall_feedback', 'AI 自动评语。')
+                                                'final_feedback': ai_result.get('overall_feedback', 'AI 自动评语。'),
+                                                'released_at': datetime.utcnow().isoformat() + "Z"
                                             })
-                                            save_onedrive_data(f"{BASE_ONEDRIVE_PATH}/submissions/{sub['homework_id']}/{get_email_hash(sub['student_email'])}/submission.json", sub)
-                                except Exception as e:
-                                    st.toast(f"❌ 处理 {sub['student_email']} 时出错: {e}")
+                                            if save_onedrive_data(sub_path, sub):
+                                                released_subs.append(sub)
+                                            graded_by_fingerprint.setdefault(fingerprint, sub)
+                                    except Exception as e:
+                                        st.toast(f"❌ 处理 {sub['student_email']} 时出错: {e}")
+                            record_gradebook_changes(course['course_id'], released_subs)
+                            if released_subs:
+                                schedule_analysis_refresh(course['course_id'], hw)
                             st.success("所有作业已处理完毕！")
                             st.cache_data.clear()
                             time.sleep(1)
@@ -740,84 +2940,66 @@ def render_course_management_view(course, teacher_email):
                                 del st.session_state.remedial_report
                                 st.rerun()
                     else:
-                        if st.button(f"📚 一键生成补习作业 ({len(graded_subs_for_remedial)}份)", key=f"batch_remedial_{hw['homework_id']}", disabled=not graded_subs_for_remedial, use_container_width=True):
+                        if st.button(f"📚 一键生成补习作业 ({remedial_count}份)", key=f"batch_remedial_{hw['homework_id']}", disabled=not remedial_count, use_container_width=True):
+                            graded_subs_for_remedial = [s for s in get_submissions_for_homework(hw['homework_id'])
+                                                        if s.get('status') == 'feedback_released' and s.get('final_grade', 100) < 80]
                             with st.spinner(f"正在为 {len(graded_subs_for_remedial)} 名学生生成作业..."):
-                                all_hw, new_hw, success_list, failed_dict = get_all_homework(), [], [], {}
-                                for sub in graded_subs_for_remedial:
-                                    try:
-                                        student_email = sub['student_email']
-                                        score_per_q = 100 / len(hw['questions']) if hw['questions'] else 100
-                                        weak_points = [
-                                            {"question": hw['questions'][g['question_index']]['question'],
-                                             "answer": sub['answers'].get(hw['questions'][g['question_index']]['id'], {}).get('text'),
-                                             "feedback": g.get('feedback')}
-                                            for g in sub.get('ai_detailed_grades', []) if g.get('grade', 0) < score_per_q
-                                        ]
-                                        if not weak_points:
-                                            continue
-                                        prompt = f"""# 角色: 个性化辅导老师. # 任务: 根据学生薄弱点创建新的补习作业. # 薄弱点: {json.dumps(weak_points, ensure_ascii=False)} # 要求: 1-2道新题, 严格JSON输出.
-{{
-"title": "个性化补习 - {hw['title']}", "questions": [{{"id": "remedial_q0", "type": "text", "question": "这里是新的补习题目..."}}]
-}}
-"""
-                                        ai_response = call_gemini_api(prompt)
-                                        if not ai_response:
-                                            failed_dict[student_email] = "AI未返回内容"
-                                            continue
-                                        new_hw_data = parse_ai_json(ai_response)
-                                        if new_hw_data:
-                                            new_hw_data.update({
-                                                "homework_id": str(uuid.uuid4()),
-                                                "course_id": course['course_id'],
-                                                "student_email": student_email,
-                                                "original_hw_id": hw['homework_id']
-                                            })
-                                            new_hw.append(new_hw_data)
-                                            success_list.append(student_email)
-                                        else:
-                                            failed_dict[student_email] = "AI返回格式无效"
-                                    except Exception as e:
-                                        failed_dict[student_email] = f"出错: {e}"
-                                if new_hw:
-                                    save_all_homework(all_hw + new_hw)
+                                new_hw, success_list, failed_dict = generate_remedial_homework(course, hw, graded_subs_for_remedial)
+                                if new_hw and not append_homework_changes(course['course_id'], [{"op": "put", "id": h['homework_id'], "value": h} for h in new_hw]):
+                                    failed_dict.update({email: "保存失败" for email in success_list})
+                                    success_list = []
                                 st.session_state.remedial_report = {'homework_id': hw['homework_id'], 'success': success_list, 'failed': failed_dict}
                                 st.cache_data.clear()
                                 st.rerun()
 
                 if st.button("导出成绩 (CSV)", key=f"export_{hw['homework_id']}", use_container_width=True):
-                    student_profiles = get_student_profiles_for_course(tuple(course.get('student_emails', [])))
                     grades_data = [{"学号": student_profiles.get(email, {}).get('student_id', 'N/A'),
                                     "姓名": student_profiles.get(email, {}).get('name', email),
-                                    "分数": submissions_map.get(email, {}).get('final_grade', 'N/A')}
+                                    "分数": hw_cells.get(email, {}).get('final_grade', 'N/A')}
                                    for email in course.get('student_emails', [])]
-                    df = pandas.DataFrame(grades_data)
+                    import pandas as pd
+                    df = pd.DataFrame(grades_data)
                     st.download_button(label="点击下载",
                                        data=df.to_csv(index=False).encode('utf-8-sig'),
                                        file_name=f"{hw['title']}_grades.csv",
                                        mime='text/csv')
 
                 st.divider()
-                student_profiles = get_student_profiles_for_course(tuple(course.get('student_emails', [])))
+                similar_matches = get_similarity_matches(course['course_id'], hw['homework_id'])
                 for student_email in course.get('student_emails', []):
                     profile = student_profiles.get(student_email, {})
-                    sub = submissions_map.get(student_email)
+                    cell = hw_cells.get(student_email)
                     cols = st.columns([3, 2, 2, 3])
                     cols[0].write(f"{profile.get('name') or student_email} ({profile.get('class_name', 'N/A')} - {profile.get('student_id', 'N/A')})")
-                    if sub:
-                        status = sub.get("status", "submitted")
+                    if similar_matches.get(student_email):
+                        others = "、".join(f"{student_profiles.get(other, {}).get('name') or other} ({similarity:.0%})"
+                                          for other, similarity in sorted(similar_matches[student_email], key=lambda m: -m[1]))
+                        cols[0].caption(f"⚠️ 疑似雷同: {others}")
+                    if cell:
+                        status = cell.get("status", "submitted")
                         if status == "submitted":
                             cols[1].info("已提交")
-                            cols[2].button("批改", key=f"grade_{sub['submission_id']}", on_click=lambda s=sub: st.session_state.update(grading_submission=s))
+                            if cols[2].button("批改", key=f"grade_{cell['submission_id']}"):
+                                sub = get_student_submission(hw['homework_id'], student_email)
+                                if sub:
+                                    st.session_state.grading_submission = sub
+                                    st.rerun()
+                                else:
+                                    cols[3].error("读取提交失败，请稍后重试。")
                         elif status == "feedback_released":
                             cols[1].success("已反馈")
-                            cols[2].metric("得分", sub.get('final_grade', 'N/A'))
-                            if cols[3].button("编辑", key=f"edit_{sub['submission_id']}"):
-                                st.session_state.grading_submission = sub
-                                if sub.get('ai_detailed_grades'):
-                                    st.session_state.ai_grade_result = {"overall_grade": sub.get('ai_grade'),
-                                                                        "overall_feedback": sub.get('ai_feedback'),
-                                                                        "detailed_grades": sub.get('ai_detailed_grades')}
-                                st.rerun()
+                            cols[2].metric("得分", cell.get('final_grade', 'N/A'))
+                            if cols[3].button("编辑", key=f"edit_{cell['submission_id']}"):
+                                sub = get_student_submission(hw['homework_id'], student_email)
+                                if sub:
+                                    st.session_state.grading_submission = sub
+                                    if sub.get('ai_detailed_grades'):
+                                        st.session_state.ai_grade_result = {"overall_grade": sub.get('ai_grade'),
+                                                                            "overall_feedback": sub.get('ai_feedback'),
+                                                                            "detailed_grades": sub.get('ai_detailed_grades')}
+                                    st.rerun()
+                                else:
+                                    cols[3].error("读取提交失败，请稍后重试。")
                     else:
                         cols[1].error("未提交")
 
@@ -825,29 +3007,52 @@ def render_course_management_view(course, teacher_email):
     with tab4:
         st.subheader("📊 班级学情分析")
         homework_list = get_course_homework(course['course_id'])
-        if not homework_list:
+        if not homework_list and is_storage_degraded():
+            st.warning("暂时无法加载作业列表，请稍后刷新。")
+        elif not homework_list:
             st.info("本课程还没有已发布的作业，无法进行分析。")
         else:
             hw_options = {hw['title']: hw['homework_id'] for hw in homework_list}
             selected_hw_title = st.selectbox("请选择要分析的作业", options=list(hw_options.keys()))
-            if st.button("开始分析", key=f"analyze_{hw_options[selected_hw_title]}", use_container_width=True):
+            homework = get_homework(course['course_id'], hw_options[selected_hw_title])
+            if not homework:
+                st.error("读取作业失败，请稍后刷新重试。")
+                return
+            cells = [c for (hw_id, _), c in get_course_gradebook(course['course_id']).items() if hw_id == homework['homework_id']]
+            fingerprint = analysis_fingerprint(homework, cells)
+            stored = get_analysis_report(course['course_id'], homework['homework_id'])
+            is_fresh = bool(stored) and stored.get('fingerprint') == fingerprint
+            if stored and not is_fresh:
+                st.info("报告生成后有新的批改结果发布，可重新生成以包含最新成绩。")
+            button_label = "重新生成分析" if stored else "开始分析"
+            if st.button(button_label, key=f"analyze_{homework['homework_id']}", use_container_width=True,
+                         type="secondary" if is_fresh else "primary",
+                         help="报告已是最新，重新生成将再次调用 AI。" if is_fresh else None):
                 with st.spinner("AI正在汇总分析全班的作业情况..."):
-                    homework = get_homework(hw_options[selected_hw_title])
-                    submissions = get_submissions_for_homework(hw_options[selected_hw_title])
-                    graded_submissions = [s for s in submissions if s.get('status') == 'feedback_released']
-                    if len(graded_submissions) < 2:
+                    document = generate_analysis_report(course['course_id'], homework, cells)
+                    if document == {}:
                         st.warning("已批改的提交人数过少，无法进行有意义的分析。")
+                    elif document is None:
+                        st.error("无法生成学情分析报告。")
                     else:
-                        summary = [{"grade": s['final_grade'], "details": s.get('ai_detailed_grades', [])} for s in graded_submissions]
-                        prompt = f"""# 角色: 教育数据分析专家. # 数据: 作业题目: {json.dumps(homework['questions'], ensure_ascii=False)}, 全班匿名批改数据: {json.dumps(summary, ensure_ascii=False)}. # 任务: 生成详细的学情分析报告，包含: 1. 总体表现总结 (平均/最高/最低分, 分数段分布). 2. 知识点掌握情况 (逐题得分率, 优劣势分析). 3. 典型错误分析. 4. 教学建议."""
-                        analysis_report = call_gemini_api(prompt)
-                        if analysis_report:
-                            st.markdown("### 学情分析报告\n" + analysis_report)
-                        else:
-                            st.error("无法生成学情分析报告。")
+                        stored = document
+                        get_analysis_report.clear()
+            if stored:
+                st.caption(f"报告生成于 {stored.get('generated_at', 'N/A')}，基于 {stored.get('graded_count', 0)} 份已批改作业。")
+                st.markdown("### 学情分析报告\n" + stored['report'])
 
 # ---------------- 学生端 ----------------
 
+def load_student_dashboard(student_email):
+    """学生仪表盘所需数据：[(课程, 该生可见的作业列表, {homework_id: 提交或 None})]。"""
+    dashboard = []
+    for course in get_student_courses(student_email):
+        all_hw = get_course_homework(course['course_id'])
+        student_hw = [hw for hw in all_hw if 'student_email' not in hw or hw.get('student_email') == student_email]
+        my_submissions = get_student_submissions((hw['homework_id'] for hw in student_hw), student_email) if student_hw else {}
+        dashboard.append((course, student_hw, my_submissions))
+    return dashboard
+
 def render_student_dashboard(student_email, user_profile):
     st.header("学生仪表盘")
     tab1, tab2, tab3 = st.tabs(["我的课程", "加入新课程", "个人信息"])
@@ -859,15 +3064,13 @@ def render_student_dashboard(student_email, user_profile):
                 if not join_code:
                     st.warning("请输入邀请码。")
                 else:
-                    all_courses = get_all_courses()
-                    target_course = next((c for c in all_courses if c.get('join_code') == join_code), None)
+                    target_course = next((c for c in get_course_catalog() if c.get('join_code') == join_code), None)
                     if not target_course:
                         st.error("邀请码无效。")
-                    elif student_email in target_course.get('student_emails', []):
+                    elif target_course['course_id'] in get_student_course_ids(student_email):
                         st.info("您已经加入此课程。")
                     else:
-                        target_course.setdefault('student_emails', []).append(student_email)
-                        if save_all_courses(all_courses):
+                        if add_student_to_course(target_course['course_id'], student_email):
                             st.success(f"成功加入课程 '{target_course['course_name']}'！")
                             st.cache_data.clear()
                             st.rerun()
@@ -876,19 +3079,22 @@ def render_student_dashboard(student_email, user_profile):
 
     with tab1:
         st.subheader("我加入的课程")
-        my_courses = get_student_courses(student_email)
-        if not my_courses:
+        dashboard = load_student_dashboard(student_email)
+        if not dashboard and is_storage_degraded():
+            st.warning("暂时无法加载课程列表，请稍后刷新。")
+            return
+        if not dashboard:
             st.info("您还没有加入任何课程。")
             return
-        for course in my_courses:
+        for course, student_hw, my_submissions in dashboard:
             with st.expander(f"**{course['course_name']}**", expanded=True):
-                all_hw = get_course_homework(course['course_id'])
-                student_hw = [hw for hw in all_hw if 'student_email' not in hw or hw.get('student_email') == student_email]
-                if not student_hw:
+                if not student_hw and is_storage_degraded():
+                    st.warning("暂时无法加载作业列表，请稍后刷新。")
+                elif not student_hw:
                     st.write("这门课还没有发布任何作业。")
                 else:
                     for hw in student_hw:
-                        submission = get_student_submission(hw['homework_id'], student_email)
+                        submission = my_submissions[hw['homework_id']]
                         cols = st.columns([3,2,2])
                         cols[0].write(f"{hw['title']}")
                         if submission:
@@ -896,6 +3102,7 @@ def render_student_dashboard(student_email, user_profile):
                                 cols[1].success(f"已批改: {submission.get('final_grade', 'N/A')}/100")
                                 if cols[2].button("查看结果", key=f"view_{hw['homework_id']}"):
                                     st.session_state.viewing_homework_id = hw['homework_id']
+                                    st.session_state.viewing_course_id = course['course_id']
                                     st.rerun()
                             else:
                                 cols[1].info("已提交")
@@ -904,6 +3111,7 @@ def render_student_dashboard(student_email, user_profile):
                             cols[1].warning("待完成")
                             if cols[2].button("开始作业", key=f"do_{hw['homework_id']}"):
                                 st.session_state.viewing_homework_id = hw['homework_id']
+                                st.session_state.viewing_course_id = course['course_id']
                                 st.rerun()
 
     with tab3:
@@ -925,12 +3133,39 @@ def render_student_dashboard(student_email, user_profile):
 
 # ---------------- 作业提交/附件渲染 ----------------
 
+def submit_homework(homework, student_email, final_answers, processed_files):
+    """
+    保存一份提交。processed_files: {blob 路径: 文件字节}，与 final_answers 中的附件引用对应。
+    成功返回提交记录，失败返回 None。
+    """
+    submission_data = {
+        "submission_id": str(uuid.uuid4()),
+        "homework_id": homework['homework_id'],
+        "student_email": student_email,
+        "answers": final_answers,
+        "status": "submitted",
+        "timestamp": datetime.utcnow().isoformat() + "Z"
+    }
+    similarity_entry = build_similarity_entry(homework, submission_data)
+    submission_data['fingerprint'] = similarity_entry['fingerprint']
+    # 附件按内容去重并发上传，submission.json 在全部附件成功后写入，相似度索引与成绩册在提交记录保存成功后才追加
+    with UnitOfWork() as uow:
+        for path, filebytes in processed_files.items():
+            uow.put_if_absent(path, filebytes)
+        uow.put_last(student_submission_path(homework['homework_id'], student_email), submission_data)
+        uow.append_last(similarity_index_path(homework['course_id'], homework['homework_id']),
+                        [{"op": "put", "id": student_email, "value": similarity_entry}])
+        uow.append_last(gradebook_path(homework['course_id']), gradebook_ops([submission_data]))
+    return submission_data if uow.succeeded else None
+
 def render_homework_submission_view(homework, student_email):
     st.header(f"作业: {homework['title']}")
     if st.button("返回课程列表"):
         st.session_state.viewing_homework_id = None
         st.rerun()
 
+    from streamlit_drawable_canvas import st_canvas
+    canvas_results = {}
     with st.form("submission_form"):
         for i, q in enumerate(homework['questions']):
             q_key = q.get('id', f'q_{i}')
@@ -941,6 +3176,10 @@ def render_homework_submission_view(homework, student_email):
                 st.radio("选择", q['options'], key=f"mc_{q_key}", horizontal=True)
             else:
                 st.text_area("回答", key=f"text_{q_key}", height=150)
+                with st.expander("✍️ 手写作答"):
+                    canvas_results[q_key] = st_canvas(stroke_width=3, stroke_color="#000000", background_color="#FFFFFF",
+                                                      width=INK_CANVAS_WIDTH, height=INK_CANVAS_HEIGHT,
+                                                      drawing_mode="freedraw", key=f"canvas_{q_key}")
             st.file_uploader("添加附件",
                              accept_multiple_files=True,
                              type=ALL_SUPPORTED_EXTENSIONS,
@@ -957,32 +3196,24 @@ def render_homework_submission_view(homework, student_email):
                         attachments = []
                         uploaded_files = st.session_state.get(f"files_{q_key}", [])
                         for uploaded_file in uploaded_files:
-                            safe_name = f"{q_key}_{uuid.uuid4().hex}.{uploaded_file.name.split('.')[-1]}"
-                            attachments.append(safe_name)
-                            processed_files[safe_name] = uploaded_file.getvalue()
+                            ref = make_attachment_ref(uploaded_file)
+                            attachments.append(ref)
+                            processed_files[blob_path(ref['sha256'], ref['ext'])] = uploaded_file.getvalue()
+                        canvas_result = canvas_results.get(q_key)
+                        ink = encode_ink_strokes(canvas_result.json_data) if canvas_result is not None else None
+                        if ink:
+                            ref = make_bytes_attachment_ref(f"第{i + 1}题手写.{INK_EXTENSION}", ink)
+                            attachments.append(ref)
+                            processed_files[blob_path(ref['sha256'], ref['ext'])] = ink
                         final_answers[q_key] = {"text": st.session_state.get(f"text_{q_key}"), "attachments": attachments}
-                prefix = f"{BASE_ONEDRIVE_PATH}/submissions/{homework['homework_id']}/{get_email_hash(student_email)}"
-                files_saved = all(save_onedrive_data(f"{prefix}/{filename}", filebytes, is_json=False)
-                                  for filename, filebytes in processed_files.items())
-                if files_saved:
-                    submission_data = {
-                        "submission_id": str(uuid.uuid4()),
-                        "homework_id": homework['homework_id'],
-                        "student_email": student_email,
-                        "answers": final_answers,
-                        "status": "submitted",
-                        "timestamp": datetime.utcnow().isoformat() + "Z"
-                    }
-                    if save_onedrive_data(f"{prefix}/submission.json", submission_data):
-                        st.success("提交成功！")
-                        st.cache_data.clear()
-                        time.sleep(2)
-                        st.session_state.viewing_homework_id = None
-                        st.rerun()
-                    else:
-                        st.error("提交失败：无法保存提交记录。")
+                if submit_homework(homework, student_email, final_answers, processed_files):
+                    st.success("提交成功！")
+                    st.cache_data.clear()
+                    time.sleep(2)
+                    st.session_state.viewing_homework_id = None
+                    st.rerun()
                 else:
-                    st.error("提交失败：一个或多个附件上传失败。")
+                    st.error("提交失败：附件或提交记录保存失败，请重试。")
 
 def render_attachment(file_path, file_name):
     ext = file_name.split('.')[-1].lower()
@@ -993,7 +3224,9 @@ def render_attachment(file_path, file_name):
             return
         try:
             mime = get_mime_type(file_name)
-            if ext in SUPPORTED_FILE_TYPES['image']:
+            if ext == INK_EXTENSION:
+                st.image(render_ink_png(hashlib.sha256(file_bytes).hexdigest(), file_bytes), caption=file_name)
+            elif ext in SUPPORTED_FILE_TYPES['image']:
                 st.image(file_bytes, caption=file_name)
             elif ext in SUPPORTED_FILE_TYPES['audio']:
                 st.audio(file_bytes, format=mime or f'audio/{ext}')
@@ -1026,8 +3259,8 @@ def render_student_graded_view(submission, homework):
             st.write(f"**题目 {i + 1}:** {q['question']}")
             if answer_data:
                 st.info(f"**我的回答:**\n\n{answer_data.get('text', '无')}")
-                for filename in answer_data.get('attachments', []):
-                    render_attachment(f"{BASE_ONEDRIVE_PATH}/submissions/{homework['homework_id']}/{get_email_hash(submission['student_email'])}/{filename}", filename)
+                for attachment in answer_data.get('attachments', []):
+                    render_attachment(attachment_path(homework['homework_id'], submission['student_email'], attachment), attachment_name(attachment))
             else:
                 st.info("未回答此题")
             ai_feedback = grades_map.get(i)
@@ -1040,33 +3273,37 @@ def render_teacher_grading_view(submission, homework):
     if st.button("返回成绩册"):
         st.session_state.grading_submission = None
         st.session_state.ai_grade_result = None
+        st.session_state.ai_question_results = None
         st.rerun()
 
     st.subheader(f"学生: {submission['student_email']}")
+    per_question = st.toggle("逐题并行批改", value=st.session_state.per_question_grading, key="pq_toggle_grading",
+                             help="每道题单独并发批改，可以只重批某一题。")
+    st.session_state.per_question_grading = per_question
+    question_results = st.session_state.ai_question_results
+    if question_results is None:
+        question_results = submission.get('ai_question_results', {})
+
+    def run_per_question_grading(force_indices=()):
+        with st.spinner("AI逐题批改中..."):
+            result, new_results, failed = grade_submission_per_question(homework, submission, question_results, force_indices)
+        st.session_state.ai_question_results = new_results
+        st.session_state.ai_grade_result = result
+        if failed:
+            st.session_state.ai_failed_questions = failed
+        st.rerun()
+
+    if st.session_state.pop('ai_failed_questions', None):
+        st.warning("部分题目批改失败，可点击对应题目的“重新批改此题”重试。")
     if st.button("🤖 AI自动批改", key=f"ai_grade_{submission['submission_id']}", use_container_width=True):
+        if per_question:
+            run_per_question_grading()
         with st.spinner("AI分析中..."):
-            all_answers = submission.get('answers', {})
-            text_part = f"【题目】:{json.dumps(homework['questions'], ensure_ascii=False)}\n【回答】:{json.dumps(all_answers, ensure_ascii=False)}"
-            prompt_parts = [AI_GRADING_PROMPT, text_part]
-            for q_key, answer_data in all_answers.items():
-                for filename in answer_data.get('attachments', []):
-                    file_path = f"{BASE_ONEDRIVE_PATH}/submissions/{homework['homework_id']}/{get_email_hash(submission['student_email'])}/{filename}"
-                    file_bytes = get_onedrive_data(file_path, is_json=False)
-                    if file_bytes:
-                        prompt_parts.append(f"--- 附件 '{filename}' ---")
-                        mime_type = get_mime_type(filename)
-                        if mime_type and mime_type.startswith('image/'):
-                            prompt_parts.append(Image.open(io.BytesIO(file_bytes)))
-                        elif mime_type:
-                            prompt_parts.append({'inline_data': {'data': file_bytes, 'mime_type': mime_type}})
-            ai_result_text = call_gemini_api(prompt_parts)
-            if ai_result_text:
-                try:
-                    st.session_state.ai_grade_result = parse_ai_json(ai_result_text)
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"AI返回格式错误: {e}")
-                    st.code(ai_result_text)
+            grading_model, prompt_parts = build_grading_request(homework, submission['student_email'], submission.get('answers', {}))
+            ai_result = call_gemini_json(prompt_parts, GRADING_RESPONSE_SCHEMA, model=grading_model)
+            if ai_result:
+                st.session_state.ai_grade_result = ai_result
+                st.rerun()
             else:
                 st.error("AI调用失败。")
 
@@ -1087,13 +3324,15 @@ def render_teacher_grading_view(submission, homework):
             st.write(f"**题目 {i + 1}:** {q['question']}")
             if answer_data:
                 st.info(f"**回答:** {answer_data.get('text', '无')}")
-                for filename in answer_data.get('attachments', []):
-                    render_attachment(f"{BASE_ONEDRIVE_PATH}/submissions/{homework['homework_id']}/{get_email_hash(submission['student_email'])}/{filename}", filename)
+                for attachment in answer_data.get('attachments', []):
+                    render_attachment(attachment_path(homework['homework_id'], submission['student_email'], attachment), attachment_name(attachment))
             else:
                 st.info("未回答")
             ai_feedback = grades_map.get(i)
             if ai_feedback:
                 st.warning(f"**AI反馈:** {ai_feedback.get('feedback', '无')}\n**建议得分:** {ai_feedback.get('grade', 'N/A')}")
+            if per_question and st.button("🔁 重新批改此题", key=f"regrade_q_{submission['submission_id']}_{i}"):
+                run_per_question_grading(force_indices={i})
 
     st.divider()
     st.subheader("教师最终审核")
@@ -1109,15 +3348,21 @@ def render_teacher_grading_view(submission, homework):
 
     button_text = "✅ 更新并反馈" if submission.get('status') == 'feedback_released' else "✅ 确认并反馈"
     if st.button(button_text, type="primary", use_container_width=True):
-        submission.update(status="feedback_released", final_grade=final_grade, final_feedback=final_feedback)
+        submission.update(status="feedback_released", final_grade=final_grade, final_feedback=final_feedback,
+                          released_at=datetime.utcnow().isoformat() + "Z")
         if ai_result:
             submission.update(ai_grade=ai_result.get('overall_grade'),
                               ai_feedback=ai_result.get('overall_feedback'),
                               ai_detailed_grades=ai_result.get('detailed_grades'))
+        if st.session_state.ai_question_results is not None:
+            submission['ai_question_results'] = st.session_state.ai_question_results
         if save_onedrive_data(f"{BASE_ONEDRIVE_PATH}/submissions/{submission['homework_id']}/{get_email_hash(submission['student_email'])}/submission.json", submission):
+            record_gradebook_changes(homework['course_id'], [submission])
+            schedule_analysis_refresh(homework['course_id'], homework)
             st.success("反馈成功！")
             st.session_state.grading_submission = None
             st.session_state.ai_grade_result = None
+            st.session_state.ai_question_results = None
             st.cache_data.clear()
             time.sleep(1)
             st.rerun()
@@ -1126,55 +3371,69 @@ def render_teacher_grading_view(submission, homework):
 
 # ---------------- 主程序 ----------------
 
-st.title("📚 在线作业平台 (Gemini 2.5 Flash 驱动)")
-check_session_from_query_params()
+def main():
+    begin_storage_run()
+    init_session_state()
+    st.title("📚 在线作业平台 (Gemini 2.5 Flash 驱动)")
+    storage_status_placeholder = st.empty()
+    check_session_from_query_params()
+    get_storage_maintenance()
+
+    if not st.session_state.get('logged_in'):
+        display_login_form()
+        st.info("👈 请在左侧侧边栏使用您的邮箱登录或注册。")
+        record_startup_timing("登录页脚本执行", APP_START)
+    else:
+        user_email = st.session_state.user_email
+        with st.sidebar:
+            st.success(f"欢迎, {user_email}")
+            if st.button("退出登录", use_container_width=True):
+                revoke_session_token(st.query_params.get("session_token", ""))
+                for key in list(st.session_state.keys()):
+                    del st.session_state[key]
+                try:
+                    st.query_params.clear()
+                except Exception:
+                    st.experimental_set_query_params()
+                st.rerun()
 
-if not st.session_state.get('logged_in'):
-    display_login_form()
-    st.info("👈 请在左侧侧边栏使用您的邮箱登录或注册。")
-else:
-    user_email = st.session_state.user_email
-    with st.sidebar:
-        st.success(f"欢迎, {user_email}")
-        if st.button("退出登录", use_container_width=True):
-            for key in list(st.session_state.keys()):
-                del st.session_state[key]
-            try:
-                st.query_params.clear()
-            except Exception:
-                st.experimental_set_query_params()
-            st.rerun()
+        user_profile = get_user_profile(user_email)
+        if not user_profile and is_storage_degraded():
+            st.warning("暂时无法连接云端存储，请稍后刷新页面。")
+        elif not user_profile:
+            st.error("无法加载您的用户配置，请尝试重新登录。")
+        elif 'role' not in user_profile:
+            st.subheader("请选择您的身份")
+            col1, col2 = st.columns(2)
+            if col1.button("我是老师", use_container_width=True):
+                user_profile['role'] = 'teacher'
+                save_user_profile(user_email, user_profile)
+                st.rerun()
+            if col2.button("我是学生", use_container_width=True):
+                user_profile['role'] = 'student'
+                save_user_profile(user_email, user_profile)
+                st.rerun()
+        else:
+            user_role = user_profile['role']
+            if st.session_state.grading_submission:
+                homework = get_homework(st.session_state.selected_course_id, st.session_state.grading_submission['homework_id'])
+                if homework:
+                    render_teacher_grading_view(st.session_state.grading_submission, homework)
+            elif st.session_state.viewing_homework_id:
+                homework = get_homework(st.session_state.viewing_course_id, st.session_state.viewing_homework_id)
+                if homework:
+                    submission = get_student_submission(homework['homework_id'], user_email)
+                    if submission and submission.get('status') == 'feedback_released':
+                        render_student_graded_view(submission, homework)
+                    else:
+                        render_homework_submission_view(homework, user_email)
+            elif user_role == 'teacher':
+                render_teacher_dashboard(user_email)
+            elif user_role == 'student':
+                render_student_dashboard(user_email, user_profile)
 
-    user_profile = get_user_profile(user_email)
-    if not user_profile:
-        st.error("无法加载您的用户配置，请尝试重新登录。")
-    elif 'role' not in user_profile:
-        st.subheader("请选择您的身份")
-        col1, col2 = st.columns(2)
-        if col1.button("我是老师", use_container_width=True):
-            user_profile['role'] = 'teacher'
-            save_user_profile(user_email, user_profile)
-            st.rerun()
-        if col2.button("我是学生", use_container_width=True):
-            user_profile['role'] = 'student'
-            save_user_profile(user_email, user_profile)
-            st.rerun()
-    else:
-        user_role = user_profile['role']
-        if st.session_state.grading_submission:
-            homework = get_homework(st.session_state.grading_submission['homework_id'])
-            if homework:
-                render_teacher_grading_view(st.session_state.grading_submission, homework)
-        elif st.session_state.viewing_homework_id:
-            homework = get_homework(st.session_state.viewing_homework_id)
-            if homework:
-                submission = get_student_submission(homework['homework_id'], user_email)
-                if submission and submission.get('status') == 'feedback_released':
-                    render_student_graded_view(submission, homework)
-                else:
-                    render_homework_submission_view(homework, user_email)
-        elif user_role == 'teacher':
-            render_teacher_dashboard(user_email)
-        elif user_role == 'student':
-            render_student_dashboard(user_email, user_profile)
+    render_storage_status_banner(storage_status_placeholder)
 
+# 以 `streamlit run app.py` 运行时 __name__ 为 "__main__"；被 loadtest.py 等工具导入时只加载函数定义
+if __name__ == "__main__":
+    main()
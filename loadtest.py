@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+提交高峰压测工具
+- 在本地启动一个模拟 OneDrive（Graph API）的 HTTP 服务，可注入延迟与限流（429）
+- 以“无界面”方式导入 app.py，用 N 个并发线程模拟学生会话：登录 → 仪表盘 → 带附件提交
+- 提交阶段所有学生同时开始，模拟截止前的集中提交
+- 输出各阶段 p50/p95/p99 延迟、失败率以及 Graph 调用次数
+
+用法：
+    python loadtest.py --students 200 --attachments 2 --attachment-kb 512 --latency-ms 80 --throttle-rate 0.01
+
+一个进程对应一个副本：进程级缓存、连接池、熔断器在所有模拟会话之间共享，与线上单副本一致。
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# ---------------- 模拟 OneDrive ----------------
+
+class FakeDrive:
+    """内存中的文件树：路径 -> {content, etag, modified}。文件夹由路径前缀隐式表示。"""
+
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _now():
+        return datetime.utcnow().isoformat() + "Z"
+
+    def _meta(self, path, entry):
+        return {"name": path.rsplit("/", 1)[-1], "size": len(entry["content"]), "eTag": entry["etag"],
+                "lastModifiedDateTime": entry["modified"],
+                "fileSystemInfo": {"lastModifiedDateTime": entry["modified"]}, "file": {}}
+
+    def _folder_exists(self, path):
+        prefix = path.rstrip("/") + "/"
+        return any(p.startswith(prefix) for p in self.files)
+
+    def get_content(self, path):
+        with self.lock:
+            entry = self.files.get(path)
+            return entry["content"] if entry else None
+
+    def get_meta(self, path):
+        with self.lock:
+            if path in self.files:
+                return self._meta(path, self.files[path])
+            if self._folder_exists(path):
+                return {"name": path.rsplit("/", 1)[-1], "folder": {}, "eTag": f'"folder-{path}"'}
+            return None
+
+    def put(self, path, content, if_match=None, if_none_match=None):
+        """返回 (状态码, 元数据)。"""
+        with self.lock:
+            entry = self.files.get(path)
+            if if_none_match == "*" and entry:
+                return 412, None
+            if if_match and (not entry or entry["etag"] != if_match):
+                return 412, None
+            self.files[path] = {"content": content, "etag": f'"{uuid.uuid4()}"', "modified": self._now()}
+            return (200 if entry else 201), self._meta(path, self.files[path])
+
+    def touch(self, path):
+        with self.lock:
+            entry = self.files.get(path)
+            if not entry:
+                return None
+            entry["modified"] = self._now()
+            return self._meta(path, entry)
+
+    def delete(self, path):
+        with self.lock:
+            prefix = path.rstrip("/") + "/"
+            doomed = [p for p in self.files if p == path or p.startswith(prefix)]
+            for p in doomed:
+                del self.files[p]
+            return bool(doomed)
+
+    def children(self, path):
+        with self.lock:
+            prefix = path.rstrip("/") + "/"
+            if not self._folder_exists(path):
+                return None
+            items = {}
+            for p, entry in self.files.items():
+                if not p.startswith(prefix):
+                    continue
+                name, _, rest = p[len(prefix):].partition("/")
+                if rest:
+                    items.setdefault(name, {"name": name, "folder": {}, "size": 0})
+                else:
+                    items[name] = self._meta(p, entry)
+            return list(items.values())
+
+    def count(self, suffix):
+        with self.lock:
+            return sum(1 for p in self.files if p.endswith(suffix))
+
+class FakeGraphServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, drive, latency_ms, jitter_ms, throttle_rate):
+        super().__init__(("127.0.0.1", 0), FakeGraphHandler)
+        self.drive = drive
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_rate = throttle_rate
+        self.faults_enabled = True
+        self.calls = Counter()
+        self.calls_lock = threading.Lock()
+
+    def count(self, key):
+        with self.calls_lock:
+            self.calls[key] += 1
+
+class FakeGraphHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _inject_faults(self, kind):
+        """按配置注入延迟与限流；返回 True 表示本次请求已按 429 处理。"""
+        server = self.server
+        if not server.faults_enabled:
+            return False
+        delay = random.gauss(server.latency_ms, server.jitter_ms) / 1000
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < server.throttle_rate:
+            server.count(f"{kind} 429")
+            self._read_body()
+            self._send(429, {"error": {"code": "TooManyRequests"}}, headers={"Retry-After": "1"})
+            return True
+        return False
+
+    def _parse(self):
+        """/v1.0/users/<u>/drive/root:/A/B.json:/content -> ("root:/A/B.json", "content")"""
+        raw = unquote(urlsplit(self.path).path)
+        _, _, item = raw.partition("/drive/")
+        parts = item.split(":/")
+        path = ":/".join(parts[:2]) if len(parts) > 1 else item
+        action = parts[2] if len(parts) > 2 else ""
+        return path, action
+
+    def do_POST(self):
+        self._read_body()
+        if self.path.endswith("/oauth2/v2.0/token"):
+            self.server.count("POST token")
+            self._send(200, {"access_token": "loadtest-token", "expires_in": 3600})
+        else:
+            self._send(404, {})
+
+    def do_GET(self):
+        path, action = self._parse()
+        kind = f"GET {action or 'metadata'}"
+        self.server.count(kind)
+        if self._inject_faults(kind):
+            return
+        drive = self.server.drive
+        if action == "content":
+            content = drive.get_content(path)
+            if content is None:
+                self._send(404, {"error": {"code": "itemNotFound"}})
+            else:
+                self._send(200, content, content_type="application/octet-stream")
+        elif action == "children":
+            items = drive.children(path)
+            self._send(404, {}) if items is None else self._send(200, {"value": items})
+        else:
+            meta = drive.get_meta(path)
+            self._send(404, {}) if meta is None else self._send(200, meta)
+
+    def do_PUT(self):
+        path, _ = self._parse()
+        self.server.count("PUT content")
+        if self._inject_faults("PUT content"):
+            return
+        status, meta = self.server.drive.put(path, self._read_body(),
+                                             if_match=self.headers.get("If-Match"),
+                                             if_none_match=self.headers.get("If-None-Match"))
+        self._send(status, meta or {"error": {"code": "preconditionFailed"}})
+
+    def do_PATCH(self):
+        path, _ = self._parse()
+        self._read_body()
+        self.server.count("PATCH metadata")
+        if self._inject_faults("PATCH metadata"):
+            return
+        meta = self.server.drive.touch(path)
+        self._send(404, {}) if meta is None else self._send(200, meta)
+
+    def do_DELETE(self):
+        path, _ = self._parse()
+        self.server.count("DELETE")
+        if self._inject_faults("DELETE"):
+            return
+        self._send(204) if self.server.drive.delete(path) else self._send(404, {})
+
+# ---------------- 加载应用 ----------------
+
+def load_app(graph_port, workdir):
+    """写入指向模拟服务的 secrets 后以模块方式导入 app.py（不会执行 main()）。"""
+    streamlit_dir = os.path.join(workdir, ".streamlit")
+    os.makedirs(streamlit_dir, exist_ok=True)
+    base = f"http://127.0.0.1:{graph_port}"
+    with open(os.path.join(streamlit_dir, "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write(f"""[microsoft_graph]
+tenant_id = "loadtest"
+client_id = "loadtest"
+client_secret = "loadtest-secret"
+sender_email = "loadtest@example.com"
+graph_base_url = "{base}/v1.0"
+login_base_url = "{base}"
+
+[session]
+secret_key = "loadtest-session-secret"
+
+[gemini_api]
+api_key = "unused"
+""")
+    os.chdir(workdir)
+    # 无界面运行时每次 st.* 调用都会告警（missing ScriptRunContext 等），压测中只保留错误日志；
+    # 同时写入配置项，避免导入 app 时 Streamlit 读取配置把日志级别重置回默认值
+    from streamlit import config as st_config, logger as st_logger
+    st_config.set_option("logger.level", "error")
+    st_logger.set_log_level("error")
+    spec = importlib.util.spec_from_file_location("homework_app", APP_PATH)
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    return app
+
+# ---------------- 压测流程 ----------------
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(pct / 100 * len(sorted_values))   # 最近秩法
+    return sorted_values[min(len(sorted_values), max(rank, 1)) - 1]
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def timed(self, phase, fn, *args):
+        started = time.perf_counter()
+        try:
+            result = fn(*args)
+            ok = bool(result)
+        except Exception:
+            result, ok = None, False
+        elapsed = (time.perf_counter() - started) * 1000
+        with self.lock:
+            self.samples.setdefault(phase, []).append((elapsed, ok))
+        return result
+
+    def report(self):
+        rows = []
+        for phase, samples in self.samples.items():
+            latencies = sorted(ms for ms, _ in samples)
+            errors = sum(1 for _, ok in samples if not ok)
+            rows.append({"phase": phase, "count": len(samples), "error_rate": errors / len(samples),
+                         "p50_ms": percentile(latencies, 50), "p95_ms": percentile(latencies, 95),
+                         "p99_ms": percentile(latencies, 99), "max_ms": latencies[-1]})
+        return rows
+
+def setup_course(app, student_emails, question_count):
+    course_id = str(uuid.uuid4())
+    course = {"course_id": course_id, "course_name": "压测课程", "teacher_email": "teacher@example.com", "join_code": "LOAD01"}
+    homework = {
+        "homework_id": str(uuid.uuid4()),
+        "course_id": course_id,
+        "title": "压测作业",
+        "questions": [{"id": f"q_{i}", "type": "text", "question": f"第 {i + 1} 题"} for i in range(question_count)],
+    }
+    if not app.append_catalog_changes([{"op": "put", "id": course_id, "value": course}]):
+        raise RuntimeError("创建课程失败")
+    if not app.append_homework_changes(course_id, [{"op": "put", "id": homework["homework_id"], "value": homework}]):
+        raise RuntimeError("发布作业失败")
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        if not all(pool.map(lambda email: app.add_student_to_course(course_id, email), student_emails)):
+            raise RuntimeError("添加学生失败")
+    return homework
+
+def student_login_and_dashboard(app, recorder, email):
+    def login():
+        if not app.issue_login_code(email):
+            return None
+        token, error, _ = app.verify_login_code(email, "111111")
+        return token if not error else None
+
+    recorder.timed("登录", login)
+    recorder.timed("仪表盘", lambda: app.load_student_dashboard(email) or None)
+
+def student_submit(app, recorder, args, homework, email):
+    def submit():
+        # 附件都挂在第一题上，内容随机，保证不会被内容去重跳过上传
+        attachments, files = [], {}
+        for k in range(args.attachments):
+            data = io.BytesIO(os.urandom(args.attachment_kb * 1024))
+            data.name = f"work_{k}.png"
+            ref = app.make_attachment_ref(data)
+            attachments.append(ref)
+            files[app.blob_path(ref["sha256"], ref["ext"])] = data.getvalue()
+        answers = {q["id"]: {"text": f"{email} 的回答 {random.random()}", "attachments": attachments if i == 0 else []}
+                   for i, q in enumerate(homework["questions"])}
+        return app.submit_homework(homework, email, answers, files)
+
+    recorder.timed("提交", submit)
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟截止前集中提交的压测工具")
+    parser.add_argument("--students", type=int, default=100, help="模拟学生数")
+    parser.add_argument("--concurrency", type=int, default=0, help="并发会话数，默认等于学生数")
+    parser.add_argument("--questions", type=int, default=3, help="作业题目数")
+    parser.add_argument("--attachments", type=int, default=1, help="每份提交的附件数")
+    parser.add_argument("--attachment-kb", type=int, default=256, help="每个附件大小（KB）")
+    parser.add_argument("--latency-ms", type=float, default=60, help="模拟 Graph 平均延迟")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="延迟标准差")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="返回 429 的请求比例")
+    parser.add_argument("--json", help="把结果另存为 JSON 文件")
+    args = parser.parse_args()
+    concurrency = args.concurrency or args.students
+
+    drive = FakeDrive()
+    server = FakeGraphServer(drive, args.latency_ms, args.jitter_ms, args.throttle_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    workdir = tempfile.mkdtemp(prefix="homework-loadtest-")
+    app = load_app(server.server_address[1], workdir)
+
+    emails = [f"student{i:04d}@loadtest.example.com" for i in range(args.students)]
+    server.faults_enabled = False
+    homework = setup_course(app, emails, args.questions)
+    server.faults_enabled = True
+    server.calls.clear()
+
+    recorder = Recorder()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda email: student_login_and_dashboard(app, recorder, email), emails))
+    login_elapsed = time.perf_counter() - started
+
+    # 截止前集中提交：全部会话同时点击“确认提交”
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda email: student_submit(app, recorder, args, homework, email), emails))
+    submit_elapsed = time.perf_counter() - started
+
+    rows = recorder.report()
+    stored = drive.count("/submission.json")
+    print(f"\n学生 {args.students}，并发 {concurrency}，附件 {args.attachments}×{args.attachment_kb}KB，"
+          f"延迟 {args.latency_ms}±{args.jitter_ms}ms，限流比例 {args.throttle_rate:.1%}\n")
+    print(f"{'阶段':<8}{'次数':>8}{'失败率':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+    for row in rows:
+        print(f"{row['phase']:<8}{row['count']:>8}{row['error_rate']:>10.1%}{row['p50_ms']:>10.0f}"
+              f"{row['p95_ms']:>10.0f}{row['p99_ms']:>10.0f}{row['max_ms']:>10.0f}")
+    print(f"\n登录+仪表盘阶段耗时 {login_elapsed:.1f}s；提交阶段耗时 {submit_elapsed:.1f}s，"
+          f"吞吐 {args.students / submit_elapsed:.1f} 份/秒；已落盘提交 {stored}/{args.students}")
+    print(f"熔断器状态: {'打开' if app.get_graph_circuit_breaker().is_open else '关闭'}")
+    print("\nGraph 调用次数:")
+    for key, count in sorted(server.calls.items()):
+        print(f"  {key:<20}{count:>8}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "phases": rows, "graph_calls": dict(server.calls),
+                       "stored_submissions": stored, "submit_seconds": submit_elapsed}, f, ensure_ascii=False, indent=2)
+    server.shutdown()
+
+if __name__ == "__main__":
+    sys.exit(main())